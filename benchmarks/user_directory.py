@@ -0,0 +1,72 @@
+"""Memory and load time of the user directory for synthetic SSB user exports.
+
+Usage: python -m benchmarks.user_directory [rows ...]
+"""
+import gc
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+from server.user_directory import parse_user_export
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+
+
+def synthetic_export(rows: int, seed: int = 42) -> bytes:
+    """A users export with roughly the shape of the real one, including rows that are filtered out."""
+    rng = random.Random(seed)
+    lines = ["userPrincipalName,displayName,mail"]
+    for i in range(rows):
+        first = rng.choice(["Anne", "Per", "Kari", "Ola", "Åse", "Øystein", "Bjørn", "Marit"])
+        last = "".join(rng.choices(string.ascii_lowercase, k=8)).capitalize()
+        if i % 50 == 1:
+            principal = f"svc-account-{i}@ssb.no"
+        elif i < 26**3:
+            principal = "".join(string.ascii_lowercase[i // 26**n % 26] for n in range(3)) + "@ssb.no"
+        else:
+            principal = f"kons{i}@ssb.no"
+        lines.append(f"{principal},{last}  {first},{first}.{last}{i}@ssb.no")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def traced_bytes(build):
+    """Bytes still allocated after calling `build`, and the result, so it is kept alive while measuring."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return allocated, result
+
+
+def measure(rows: int):
+    content = synthetic_export(rows)
+
+    started = time.perf_counter()
+    directory = parse_user_export(content)
+    load_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    directory.warm()
+    warm_seconds = time.perf_counter() - started
+    users = len(directory)
+    del directory
+
+    directory_bytes, directory = traced_bytes(lambda: parse_user_export(content))
+    warm_bytes, _ = traced_bytes(directory.warm)
+    dict_bytes, _ = traced_bytes(directory.as_dicts)
+
+    print(
+        f"{rows:>9} rows {users:>9} users | "
+        f"load {load_seconds:6.2f}s {directory_bytes / users:5.0f} B/user | "
+        f"indexes and encoded responses {warm_seconds:6.2f}s {warm_bytes / users:5.0f} B/user | "
+        f"as dicts {dict_bytes / users:5.0f} B/user"
+    )
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    for size in sizes:
+        measure(size)
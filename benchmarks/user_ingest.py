@@ -0,0 +1,48 @@
+"""Chunked/parallel ingestion of the users export compared with the row-by-row loop.
+
+Usage: python -m benchmarks.user_ingest [rows ...]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.user_directory import synthetic_export
+from server.user_directory import parse_user_export
+from server.user_ingest import ingest_user_export
+
+DEFAULT_SIZES = (100_000, 1_000_000, 3_000_000)
+
+
+def timed(function):
+    started = time.perf_counter()
+    result = function()
+    return time.perf_counter() - started, result
+
+
+def measure(rows: int):
+    with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as file:
+        file.write(synthetic_export(rows))
+    try:
+        def row_loop():
+            with open(file.name, mode="rb") as csv_file:
+                return parse_user_export(csv_file.read())
+
+        row_loop_seconds, expected = timed(row_loop)
+        chunked_seconds, chunked = timed(lambda: ingest_user_export(file.name, workers=1))
+        workers = os.cpu_count() or 1
+        parallel_seconds, parallel = timed(lambda: ingest_user_export(file.name, workers=workers))
+        assert len(chunked) == len(parallel) == len(expected)
+
+        print(
+            f"{rows:>9} rows | row loop {row_loop_seconds:6.2f}s | "
+            f"chunked {chunked_seconds:6.2f}s | parallel ({workers} workers) {parallel_seconds:6.2f}s"
+        )
+    finally:
+        os.unlink(file.name)
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    for size in sizes:
+        measure(size)
@@ -1,21 +1,59 @@
-import csv
+import asyncio
+import datetime
 import os
+import tempfile
 from server import __version__
 from subprocess import CalledProcessError
 
-from fastapi import Depends, FastAPI, Header, HTTPException
+from fastapi import Body, Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from prometheus_fastapi_instrumentator import Instrumentator
 from requests import HTTPError
-from typing import Optional
+from typing import List, Optional
 
-from .clients import JiraClient, KlassClient
+from . import metrics
+from .cache import DiskResponseCache
+from .clients import CachingKlassClient, JiraClient, KlassClient
 from .project_details import ProjectDetails, project_user_from_jwt
 from .create_jira_issue import create_issue_basic
-from .org_info import produce_org_info, get_klass_sectional_division
+from .idempotency import IdempotencyCache, IdempotencyKeyReused, fingerprint
+from .jira_jobs import FAILED, JiraJobQueue
+from .resilience import CircuitBreaker, CircuitOpenError, RetryPolicy
+from .org_info import NoVersionError, OrgInfoService
 from .config import logger, configure_loggers
+from .user_store import SqliteUserStore, SqliteUserStoreProvider
+from .responses import accepts_ndjson, ndjson_response, pre_encoded_response
+from .user_provider import UserDirectoryProvider
+from .user_directory import (
+    UserDirectory,
+    UserLookupRequest,
+    decode_cursor,
+    encode_cursor,
+    parse_fields,
+)
 
 SSB_USERS_SOURCE = os.environ.get("SSB_USERS_SOURCE", "tests/test-users-export.csv")
+SSB_USERS_DB = os.environ.get("SSB_USERS_DB")
+SSB_USERS_RELOAD_INTERVAL_SECONDS = float(
+    os.environ.get("SSB_USERS_RELOAD_INTERVAL_SECONDS", "30")
+)
+KLASS_CACHE_TTL_SECONDS = float(os.environ.get("KLASS_CACHE_TTL_SECONDS", "3600"))
+KLASS_CACHE_STALE_SECONDS = float(os.environ.get("KLASS_CACHE_STALE_SECONDS", "86400"))
+KLASS_CACHE_DIR = os.environ.get(
+    "KLASS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "dapla-start-api", "klass")
+)
+ORG_INFO_REFRESH_SECONDS = float(os.environ.get("ORG_INFO_REFRESH_SECONDS", "600"))
+JIRA_POOL_SIZE = int(os.environ.get("JIRA_POOL_SIZE", "10"))
+JIRA_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("JIRA_CONNECT_TIMEOUT_SECONDS", "5"))
+JIRA_READ_TIMEOUT_SECONDS = float(os.environ.get("JIRA_READ_TIMEOUT_SECONDS", "30"))
+JIRA_RETRY_ATTEMPTS = int(os.environ.get("JIRA_RETRY_ATTEMPTS", "4"))
+JIRA_RETRY_MAX_DELAY_SECONDS = float(os.environ.get("JIRA_RETRY_MAX_DELAY_SECONDS", "10"))
+JIRA_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("JIRA_BREAKER_FAILURE_THRESHOLD", "5"))
+JIRA_BREAKER_RESET_SECONDS = float(os.environ.get("JIRA_BREAKER_RESET_SECONDS", "30"))
+JIRA_JOB_WORKERS = int(os.environ.get("JIRA_JOB_WORKERS", "4"))
+JIRA_JOB_RETENTION_SECONDS = float(os.environ.get("JIRA_JOB_RETENTION_SECONDS", "3600"))
+IDEMPOTENCY_WINDOW_SECONDS = float(os.environ.get("IDEMPOTENCY_WINDOW_SECONDS", "600"))
 
 configure_loggers()
 app = FastAPI()
@@ -24,12 +62,81 @@ instrumentator = Instrumentator(
 ).instrument(app)
 
 
+jira_client = JiraClient(
+    "https://statistics-norway.atlassian.net/rest/api/3",
+    pool_size=JIRA_POOL_SIZE,
+    connect_timeout=JIRA_CONNECT_TIMEOUT_SECONDS,
+    read_timeout=JIRA_READ_TIMEOUT_SECONDS,
+    retry=RetryPolicy(
+        attempts=JIRA_RETRY_ATTEMPTS, max_delay=JIRA_RETRY_MAX_DELAY_SECONDS
+    ),
+    breaker=CircuitBreaker(
+        failure_threshold=JIRA_BREAKER_FAILURE_THRESHOLD,
+        reset_timeout=JIRA_BREAKER_RESET_SECONDS,
+        on_state_change=metrics.jira_circuit_breaker_state.state,
+    ),
+)
+
+
 def get_jira_client():
-    return JiraClient("https://statistics-norway.atlassian.net/rest/api/3")
+    return jira_client
+
+
+jira_jobs = JiraJobQueue(
+    workers=JIRA_JOB_WORKERS, retention=JIRA_JOB_RETENTION_SECONDS
+)
+
+
+def get_jira_jobs():
+    return jira_jobs
+
+
+idempotency_cache = IdempotencyCache(window=IDEMPOTENCY_WINDOW_SECONDS)
+
+
+def get_idempotency_cache():
+    return idempotency_cache
+
+
+klass_response_cache = DiskResponseCache(KLASS_CACHE_DIR)
+metrics.klass_data_age.set_function(lambda: klass_response_cache.age() or 0)
+uncached_klass_client = KlassClient(
+    "https://data.ssb.no/api/klass/v1", response_cache=klass_response_cache
+)
+klass_client = CachingKlassClient(
+    uncached_klass_client,
+    ttl=KLASS_CACHE_TTL_SECONDS,
+    stale_while_revalidate=KLASS_CACHE_STALE_SECONDS,
+)
 
 
 def get_klass_client():
-    return KlassClient("https://data.ssb.no/api/klass/v1")
+    return klass_client
+
+
+def get_klass_response_cache():
+    return klass_response_cache
+
+
+org_info_service = OrgInfoService()
+metrics.klass_data_stale.set_function(lambda: int(org_info_service.stale()))
+
+
+def get_org_info_service():
+    return org_info_service
+
+
+if SSB_USERS_DB:
+    user_directory_provider = SqliteUserStoreProvider(
+        SSB_USERS_SOURCE, SqliteUserStore(SSB_USERS_DB)
+    )
+else:
+    user_directory_provider = UserDirectoryProvider(SSB_USERS_SOURCE)
+background_tasks = set()
+
+
+def get_user_directory():
+    return user_directory_provider.get()
 
 
 app.add_middleware(
@@ -38,12 +145,51 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Readable by the cross-origin UI, e.g. for pagination
+    expose_headers=[
+        "X-Next-Cursor",
+        "Link",
+        "Location",
+        "X-Data-Age",
+        "X-Data-Stale",
+        "Idempotent-Replayed",
+    ],
 )
 
 
 @app.on_event("startup")
 async def startup_event():
     instrumentator.expose(app)
+    try:
+        user_directory_provider.load()
+    except Exception as error:
+        # Not fatal, loading is retried on first use and by the watcher
+        logger.exception(f"Failed to load users from {SSB_USERS_SOURCE}: {error}")
+    background_tasks.add(
+        asyncio.create_task(
+            # Not through the TTL cache, so every refresh revalidates the data with Klass
+            org_info_service.keep_refreshed(
+                uncached_klass_client, ORG_INFO_REFRESH_SECONDS
+            )
+        )
+    )
+    background_tasks.add(asyncio.create_task(asyncio.to_thread(jira_client.warm_up)))
+    if SSB_USERS_RELOAD_INTERVAL_SECONDS > 0:
+        background_tasks.add(
+            asyncio.create_task(
+                user_directory_provider.watch(SSB_USERS_RELOAD_INTERVAL_SECONDS)
+            )
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await klass_client.aclose()
+    jira_jobs.shutdown()
+    jira_client.close()
 
 
 @app.get("/health/liveness")
@@ -53,19 +199,38 @@ def health_liveness():
 
 
 @app.get("/health/readiness")
-def health_readiness():
-    """Can be used to poll for API readiness"""
+def health_readiness(org_info: OrgInfoService = Depends(get_org_info_service)):
+    """Can be used to poll for API readiness
+
+    The API is ready when the organization information has been loaded.
+    """
+    if not org_info.ready:
+        return JSONResponse(
+            {"name": "dapla-start-api", "status": "DOWN"}, status_code=503
+        )
     return {"name": "dapla-start-api", "status": "UP"}
 
 
 @app.post("/create_jira", status_code=201)
 def create_issue(
     details: ProjectDetails,
+    response: Response,
     authorization: Optional[str] = Header(None),
+    prefer: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None),
     client: JiraClient = Depends(get_jira_client),
+    jobs: JiraJobQueue = Depends(get_jira_jobs),
+    idempotency: IdempotencyCache = Depends(get_idempotency_cache),
 ):
     """
     Endpoint for Jira issue creation using basic auth
+
+    With the `Prefer: respond-async` header, the issue is created in the background. The response
+    is then 202 with the job, and its status can be polled at /create_jira/jobs/{id}.
+
+    Repeated requests with the same `Idempotency-Key` header (or without one, the same details)
+    within the idempotency window get the response to the first one, with `Idempotent-Replayed: true`,
+    instead of creating another issue.
     """
     try:
         logger.info(
@@ -77,7 +242,42 @@ def create_issue(
             logger.info("Reported by: %s" % details.reporter)
 
         details.api_version = __version__
-        return client.create_issue(create_issue_basic(details))
+        respond_async = prefers_respond_async(prefer)
+
+        def create():
+            issue = create_issue_basic(details)
+            if respond_async:
+                # Only the job id is remembered, replays report the current state of the job
+                return jobs.submit(client, issue).id
+            return client.create_issue(issue)
+
+        details_fingerprint = fingerprint(details)
+        key = (respond_async, idempotency_key or details_fingerprint)
+        result, replayed = idempotency.run(key, create, details_fingerprint)
+        if respond_async:
+            job = jobs.get(result)
+            if replayed and (job is None or job.status == FAILED):
+                # A failed job is not remembered, so the issue creation can be retried
+                idempotency.forget(key, result)
+                result, replayed = idempotency.run(key, create, details_fingerprint)
+                job = jobs.get(result)
+            result = job.as_dict()
+            response.status_code = 202
+            response.headers["Location"] = f"/create_jira/jobs/{job.id}"
+            response.headers["Preference-Applied"] = "respond-async"
+        if replayed:
+            logger.info("Replaying the response to an earlier identical request")
+            response.headers["Idempotent-Replayed"] = "true"
+        return result
+    except IdempotencyKeyReused as error:
+        raise HTTPException(status_code=422, detail=str(error))
+    except CircuitOpenError as error:
+        logger.error("Not calling Jira: %s", error)
+        raise HTTPException(
+            status_code=503,
+            detail=f"Jira is unavailable: {error}",
+            headers={"Retry-After": str(max(1, round(error.retry_after)))},
+        )
     except CalledProcessError as error:
         logger.exception("Error occurred: %s", error)
         raise HTTPException(
@@ -93,78 +293,269 @@ def create_issue(
         raise HTTPException(status_code=500, detail=f"Error occurred:\n\n{error}")
 
 
+@app.post("/create_jira/bulk")
+def create_issues(
+    details: List[ProjectDetails] = Body(..., max_length=1000),
+    authorization: Optional[str] = Header(None),
+    client: JiraClient = Depends(get_jira_client),
+):
+    """
+    Endpoint for creating Jira issues for several teams at once
+
+    The issues are created with Jira's bulk API, in batches of up to 50 issues. The response has a
+    result per team, in order, with "status" either "created" (and the "issue") or "failed" (and
+    the "error").
+    """
+    try:
+        logger.info(f"Got a bulk jira issue creation request for {len(details)} teams")
+        reporter = None
+        if authorization is not None:
+            bearer, _, token = authorization.partition(" ")
+            reporter = project_user_from_jwt(token)
+            logger.info("Reported by: %s" % reporter)
+
+        results: List[Optional[dict]] = [None] * len(details)
+        issues, positions = [], []
+        for position, team_details in enumerate(details):
+            if reporter is not None:
+                team_details.reporter = reporter
+            team_details.api_version = __version__
+            try:
+                issues.append(create_issue_basic(team_details))
+                positions.append(position)
+            except Exception as error:
+                logger.exception("Error occurred: %s", error)
+                results[position] = {"status": "failed", "error": str(error)}
+
+        for position, result in zip(positions, client.create_issues(issues)):
+            results[position] = result
+        return {"results": results}
+    except HTTPError as error:
+        logger.exception("Error occurred: %s", error)
+        raise HTTPException(
+            status_code=500, detail=f"Error occurred:\n\n{error.response.text}"
+        )
+    except Exception as error:
+        logger.exception("Error occurred: %s", error)
+        raise HTTPException(status_code=500, detail=f"Error occurred:\n\n{error}")
+
+
+@app.get("/create_jira/jobs/{job_id}")
+def get_create_issue_job(job_id: str, jobs: JiraJobQueue = Depends(get_jira_jobs)):
+    """
+    Get the status of a Jira issue creation job, and the issue key once it is done
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job.as_dict()
+
+
+def prefers_respond_async(prefer: Optional[str]) -> bool:
+    if not prefer:
+        return False
+    return any(
+        preference.split(";")[0].strip().lower() == "respond-async"
+        for preference in prefer.split(",")
+    )
+
+
 @app.get("/users")
-def list_users(fields: str = None):
+def list_users(
+    request: Request,
+    fields: str = None,
+    limit: Optional[int] = Query(None, ge=1, le=10000),
+    cursor: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+    directory: UserDirectory = Depends(get_user_directory),
+):
     """List all applicable SSB users.
 
     Only return users that:
     * Has a valid first- and surname
     * Has an active account
     * Has a short email starting with 3 letters OR has a "kons" prefix
-    """
-    all_fields = set(["name", "email", "email_short"])
-    fields_filter = (
-        set([f.strip() for f in fields.split(",")]) if fields else all_fields
-    )
-    fields_filter = fields_filter.intersection(all_fields)
-    if len(fields_filter) == 0:
-        fields_filter = all_fields
 
-    users = []
-    with open(SSB_USERS_SOURCE, mode="r", encoding="utf-8-sig") as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        line_count = 0
-        for row in csv_reader:
-            if line_count == 0:
-                line_count += 1
+    The users are served from an in-memory snapshot of SSB_USERS_SOURCE, see server.user_provider.
+    Responses are encoded once per snapshot and field projection, and carry an ETag that can be
+    used with If-None-Match.
 
-            skip = False
-            display_name = row["displayName"].strip()
-            principal = row["userPrincipalName"].strip()
+    With `limit` and/or `cursor`, users are paginated in email_short order, and the cursor of the
+    next page is returned in the X-Next-Cursor and Link headers.
+    With `Accept: application/x-ndjson`, users are streamed as newline delimited JSON.
+    """
+    selected_fields = parse_fields(fields)
+    paginated = limit is not None or cursor is not None
+
+    if not paginated and not accepts_ndjson(accept):
+        encoded = directory.encoded(selected_fields)
+        return pre_encoded_response(
+            encoded.body,
+            encoded.gzip_body,
+            encoded.etag,
+            encoded.gzip_etag,
+            if_none_match=if_none_match,
+            accept_encoding=accept_encoding,
+        )
 
-            # Skip users without proper name
-            if len(display_name) == 0:
-                skip = True
+    headers = {}
+    if paginated:
+        try:
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError as error:
+            raise HTTPException(status_code=400, detail=str(error))
+        users, next_after = directory.page(after, limit)
+        if next_after is not None:
+            next_cursor = encode_cursor(next_after)
+            next_url = request.url.include_query_params(cursor=next_cursor)
+            headers["X-Next-Cursor"] = next_cursor
+            headers["Link"] = f'<{next_url}>; rel="next"'
+    else:
+        users = directory.users
+
+    rows = (user.as_dict(selected_fields) for user in users)
+    if accepts_ndjson(accept):
+        return ndjson_response(rows, headers=headers)
+    return JSONResponse(list(rows), headers=headers)
+
+
+@app.get("/users/search")
+def search_users(
+    q: str,
+    limit: int = Query(10, ge=1, le=100),
+    mode: str = Query("prefix", pattern="^(prefix|fuzzy)$"),
+    fields: str = None,
+    directory: UserDirectory = Depends(get_user_directory),
+):
+    """Typeahead search for SSB users.
+
+    In `prefix` mode, returns at most `limit` users where every word in `q` is a prefix of the
+    user's name, short email or email.
+    In `fuzzy` mode, returns at most `limit` users ranked by similarity, tolerating typos and
+    missing diacritics (e.g. "aberg" finds "Åberg").
+    """
+    selected_fields = parse_fields(fields)
+    search = directory.fuzzy_search if mode == "fuzzy" else directory.search
+    return [user.as_dict(selected_fields) for user in search(q, limit)]
 
-            # Only keep accounts with principals with "3-letter" and those starting with "kons"
-            elif not (
-                len(principal) > 4
-                and (principal[3] == "@" or principal.startswith("kons"))
-            ):
-                skip = True
 
-            if not skip:
-                user = {}
+@app.post("/users/lookup")
+def lookup_users(
+    request: UserLookupRequest,
+    fields: str = None,
+    directory: UserDirectory = Depends(get_user_directory),
+):
+    """Resolve a list of principals (email_short) to users.
 
-                if "name" in fields_filter:
-                    user["name"] = display_name.replace("  ", ", ", 1)
+    Returns the matching users, in the order requested, and the principals that are unknown.
+    """
+    selected_fields = parse_fields(fields)
+    found, unknown = directory.lookup(request.principals)
+    return {
+        "users": [user.as_dict(selected_fields) for user in found],
+        "unknown": unknown,
+    }
 
-                if "email" in fields_filter:
-                    user["email"] = str(row["mail"]).lower()
 
-                if "email_short" in fields_filter:
-                    user["email_short"] = principal
+@app.get("/org_info", status_code=200)
+async def list_org_info(
+    response: Response,
+    date: Optional[datetime.date] = Query(
+        None, description="List the sections valid on this date (YYYY-MM-DD) instead of today"
+    ),
+    client: KlassClient = Depends(get_klass_client),
+    org_info: OrgInfoService = Depends(get_org_info_service),
+    response_cache: DiskResponseCache = Depends(get_klass_response_cache),
+):
+    """List organization information
 
-                users.append(user)
+    Served from memory, the data is prefetched at startup and refreshed in the background.
+    If Klass is unavailable, the last known good data is served. The X-Data-Age header tells how
+    many seconds ago the data was last confirmed by Klass, and X-Data-Stale is true while Klass
+    can not be reached.
 
-            line_count += 1
+    With `date`, the sections of the version valid on that date are listed. Versions are fetched
+    from Klass the first time they are asked for, and kept in memory after that.
+    """
+    try:
+        result = await org_info.get(client, date)
+    except NoVersionError as error:
+        raise HTTPException(status_code=404, detail=str(error))
+    except Exception as error:
+        raise org_info_error(error)
 
-    return users
+    set_data_age_headers(response, response_cache, org_info.stale(date))
+    return result
 
 
-@app.get("/org_info", status_code=200)
-def list_org_info(client: KlassClient = Depends(get_klass_client)):
-    """List organization information"""
+@app.get("/org_info/tree", status_code=200)
+async def org_info_tree(
+    response: Response,
+    client: KlassClient = Depends(get_klass_client),
+    org_info: OrgInfoService = Depends(get_org_info_service),
+    response_cache: DiskResponseCache = Depends(get_klass_response_cache),
+):
+    """Get the organization as a tree, where each division lists its sections as children"""
     try:
-        sectional_division_versions = client.get_sectional_division_versions()
-        newest_version_url = get_klass_sectional_division(sectional_division_versions)
-        newest_version_data = client.get_latest_sectional_division_version(
-            newest_version_url
-        )
+        org_index = await org_info.index(client)
+    except Exception as error:
+        raise org_info_error(error)
+
+    set_data_age_headers(response, response_cache, org_info.stale(index=True))
+    return org_index.tree
+
 
-        return produce_org_info(newest_version_data)
+@app.get("/org_info/{code}", status_code=200)
+async def get_org_unit(
+    code: str,
+    response: Response,
+    client: KlassClient = Depends(get_klass_client),
+    org_info: OrgInfoService = Depends(get_org_info_service),
+    response_cache: DiskResponseCache = Depends(get_klass_response_cache),
+):
+    """Get the division or section with the given code"""
+    try:
+        org_index = await org_info.index(client)
+    except Exception as error:
+        raise org_info_error(error)
+
+    item = org_index.get(code)
+    if item is None:
+        raise HTTPException(status_code=404, detail=f"Unknown organization code {code}")
+    set_data_age_headers(response, response_cache, org_info.stale(index=True))
+    return item
+
+
+@app.get("/org_info/{code}/children", status_code=200)
+async def list_org_unit_children(
+    code: str,
+    response: Response,
+    client: KlassClient = Depends(get_klass_client),
+    org_info: OrgInfoService = Depends(get_org_info_service),
+    response_cache: DiskResponseCache = Depends(get_klass_response_cache),
+):
+    """List the sections of the division with the given code"""
+    try:
+        org_index = await org_info.index(client)
     except Exception as error:
-        error_text = f"Error occurred while getting organization information: {error}"
-        logger.error(error_text)
+        raise org_info_error(error)
+
+    if org_index.get(code) is None:
+        raise HTTPException(status_code=404, detail=f"Unknown organization code {code}")
+    set_data_age_headers(response, response_cache, org_info.stale(index=True))
+    return org_index.children_of(code)
+
+
+def org_info_error(error: Exception) -> HTTPException:
+    error_text = f"Error occurred while getting organization information: {error}"
+    logger.error(error_text)
+    return HTTPException(status_code=500, detail=error_text)
+
 
-        raise HTTPException(status_code=500, detail=error_text)
+def set_data_age_headers(response: Response, response_cache: DiskResponseCache, stale: bool):
+    age = response_cache.age()
+    if age is not None:
+        response.headers["X-Data-Age"] = str(int(age))
+    response.headers["X-Data-Stale"] = str(stale).lower()
@@ -0,0 +1,174 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from .config import logger
+
+
+class StaleResponse(Exception):
+    """The upstream service could not be reached, `value` is its last known good response.
+
+    Raised rather than returned, so callers can tell the last known good response from a fresh one,
+    and a TTLCache does not keep it as a fresh entry.
+    """
+
+    def __init__(self, value: Any, reason: Exception):
+        super().__init__(f"Serving the last known good response: {reason}")
+        self.value = value
+
+
+@dataclass
+class _Entry:
+    value: Any
+    fetched_at: float
+
+
+class TTLCache:
+    """In-memory cache of coroutine results with a time-to-live and stale-while-revalidate semantics.
+
+    * Entries younger than `ttl` are served from the cache.
+    * Entries older than `ttl`, but within `stale_while_revalidate` seconds after that, are served
+      from the cache while a background task refreshes them.
+    * Older entries (and missing ones) are loaded before returning.
+
+    If a background refresh fails, the stale entry is kept and the refresh is retried on a later get.
+    Failed loads, including StaleResponse, are not cached.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        stale_while_revalidate: float = 0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self._clock = clock
+        self._entries: Dict[Hashable, _Entry] = {}
+        self._refreshing = set()
+        self._tasks = set()
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = self._clock() - entry.fetched_at
+            if age < self.ttl:
+                return entry.value
+            if age < self.ttl + self.stale_while_revalidate:
+                self._refresh_in_background(key, loader)
+                return entry.value
+        return await self._load(key, loader)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        value = await loader()
+        self._entries[key] = _Entry(value, self._clock())
+        return value
+
+    def _refresh_in_background(self, key: Hashable, loader: Callable[[], Awaitable[Any]]):
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+
+        async def refresh():
+            try:
+                await self._load(key, loader)
+            except Exception as error:
+                logger.warning(f"Background refresh of {key} failed, serving stale value: {error}")
+            finally:
+                self._refreshing.discard(key)
+
+        # Keep a reference to the task, the event loop only keeps a weak one
+        task = asyncio.create_task(refresh())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def clear(self):
+        self._entries.clear()
+
+
+@dataclass
+class CachedResponse:
+    body: Any
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class DiskResponseCache:
+    """Last known good copies of JSON responses, kept in memory and (optionally) on disk.
+
+    Entries keep their ETag and Last-Modified headers, so they can be revalidated with conditional
+    requests. Since they are written to `directory`, they survive restarts and can be served when
+    the upstream service is unavailable.
+
+    `age` is the time since a response was last fetched or revalidated successfully.
+    """
+
+    def __init__(self, directory: Optional[str] = None, clock: Callable[[], float] = time.time):
+        self.directory = directory
+        self._clock = clock
+        self._entries: Dict[str, CachedResponse] = {}
+        self._lock = threading.Lock()
+        self.last_success_at: Optional[float] = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url: str) -> Optional[str]:
+        if not self.directory:
+            return None
+        return os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(url)
+        path = self._path(url)
+        if entry is None and path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as file:
+                    stored = json.load(file)
+                entry = CachedResponse(stored["body"], stored.get("etag"), stored.get("last_modified"))
+                self._entries[url] = entry
+                if self.last_success_at is None:
+                    self.last_success_at = stored.get("validated_at")
+            except (OSError, ValueError, KeyError) as error:
+                logger.warning(f"Ignoring unreadable cache entry for {url}: {error}")
+        return entry
+
+    def store(self, url: str, entry: CachedResponse):
+        self._entries[url] = entry
+        self.revalidated(url)
+
+    def revalidated(self, url: str):
+        """Record that the cached response for the url was confirmed (or fetched) upstream."""
+        now = self._clock()
+        self.last_success_at = now
+        entry = self._entries[url]
+        path = self._path(url)
+        if path:
+            try:
+                with self._lock:
+                    with tempfile.NamedTemporaryFile(
+                        "w", dir=self.directory, delete=False, encoding="utf-8"
+                    ) as file:
+                        json.dump(
+                            {
+                                "url": url,
+                                "body": entry.body,
+                                "etag": entry.etag,
+                                "last_modified": entry.last_modified,
+                                "validated_at": now,
+                            },
+                            file,
+                        )
+                    os.replace(file.name, path)
+            except OSError as error:
+                logger.warning(f"Could not write cache entry for {url}: {error}")
+
+    def age(self) -> Optional[float]:
+        if self.last_success_at is None:
+            return None
+        return max(0.0, self._clock() - self.last_success_at)
@@ -1,9 +1,88 @@
+import asyncio
+import httpx
 import requests
 import os
+import threading
+from datetime import date
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+from urllib.parse import urlencode
+
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import metrics
+from .cache import CachedResponse, DiskResponseCache, StaleResponse, TTLCache
 from .config import logger
+from .resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, send_with_retries
 
 
 content_type_json = "application/json"
+# Maximum number of issues in a request to Jira's bulk create API
+BULK_CREATE_LIMIT = 50
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one.
+
+    While a call for a key is in flight, other callers with the same key wait for it and get its
+    result (or exception) instead of starting their own.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, function: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = function()
+            except BaseException as error:
+                call.error = error
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines running on an event loop.
+
+    The call runs as a task, so it completes (for the other waiters) even if the caller that
+    started it is cancelled.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, function: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = asyncio.ensure_future(function())
+            call.add_done_callback(lambda _: self._forget(key, call))
+        return await asyncio.shield(call)
+
+    def _forget(self, key: Hashable, call: asyncio.Future):
+        if self._calls.get(key) is call:
+            del self._calls[key]
 
 
 class AbstractClient:
@@ -14,15 +93,143 @@ class AbstractClient:
         self._base_url = base_url.rstrip('/')
 
 
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        metrics.jira_connections_opened.inc()
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        metrics.jira_connections_opened.inc()
+        return super()._new_conn()
+
+
+def _json_or_none(response: requests.Response):
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+class JiraHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter counting the connections it opens, to tell how well connections are reused."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
 class JiraClient(AbstractClient):
+    """Client for the Jira API.
+
+    Requests share one session with a pool of up to `pool_size` keep-alive connections, so only the
+    first request (or `warm_up`) pays for DNS lookup, connect and TLS handshake.
+
+    Transient failures are retried according to `retry`, see resilience.send_with_retries, and with a
+    `breaker` calls fail fast with CircuitOpenError while Jira is unhealthy.
+    """
+
+    def __init__(
+            self,
+            base_url,
+            pool_size: int = 10,
+            connect_timeout: float = 5,
+            read_timeout: float = 30,
+            retry: Optional[RetryPolicy] = None,
+            breaker: Optional[CircuitBreaker] = None,
+    ):
+        super().__init__(base_url)
+        self._timeout = (connect_timeout, read_timeout)
+        self._retry = retry or RetryPolicy()
+        self._breaker = breaker
+        self._session = requests.Session()
+        adapter = JiraHTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
 
     def create_issue(self, json):
         url = self._base_url + "/issue"
         logger.info(f"Calling endpoint:{url}")
-        response = requests.post(url, headers=self.create_headers(), json=json)
+        headers = self.create_headers()
+
+        def send():
+            metrics.jira_requests.inc()
+            return self._session.post(url, headers=headers, json=json, timeout=self._timeout)
+
+        response = send_with_retries(send, self._retry, self._breaker)
         response.raise_for_status()
         return response.json()
 
+    def create_issues(self, issues: List[dict]) -> List[dict]:
+        """Create issues with Jira's bulk API, in batches of up to BULK_CREATE_LIMIT issues.
+
+        Returns a result per issue, in order: {"status": "created", "issue": {id, key, self}}, or
+        {"status": "failed", "error": ...} if Jira rejected the issue or its batch failed.
+        """
+        if not issues:
+            return []
+        # Raises before any batch is sent if the credentials are missing
+        headers = self.create_headers()
+        results = []
+        for start in range(0, len(issues), BULK_CREATE_LIMIT):
+            batch = issues[start:start + BULK_CREATE_LIMIT]
+            try:
+                results.extend(self._create_batch(batch, headers))
+            except (requests.RequestException, CircuitOpenError, ValueError) as error:
+                logger.exception("Error occurred creating issues in bulk: %s", error)
+                detail = error.response.text if isinstance(error, requests.HTTPError) else str(error)
+                results.extend({"status": "failed", "error": detail} for _ in batch)
+        return results
+
+    def _create_batch(self, batch: List[dict], headers: dict) -> List[dict]:
+        url = self._base_url + "/issue/bulk"
+        logger.info(f"Calling endpoint:{url} with {len(batch)} issues")
+
+        def send():
+            metrics.jira_requests.inc()
+            return self._session.post(
+                url, headers=headers, json={"issueUpdates": batch}, timeout=self._timeout
+            )
+
+        response = send_with_retries(send, self._retry, self._breaker)
+        body = _json_or_none(response)
+        # Jira responds 400, with the errors per issue, when no issue in the batch could be created
+        if response.status_code != 400 or not isinstance(body, dict) or "errors" not in body:
+            response.raise_for_status()
+            body = response.json()
+
+        errors = {error["failedElementNumber"]: error for error in body.get("errors", [])}
+        created = iter(body.get("issues", []))
+        results = []
+        for position in range(len(batch)):
+            if position in errors:
+                results.append({"status": "failed", "error": errors[position].get("elementErrors")})
+            else:
+                # Created issues are listed in the order of the request, without the failed ones
+                issue = next(created, None)
+                if issue is None:
+                    results.append({"status": "failed", "error": "Missing from the Jira response"})
+                else:
+                    results.append({"status": "created", "issue": issue})
+        return results
+
+    def warm_up(self):
+        """Open a connection to Jira ahead of the first request. Failures are logged and ignored."""
+        url = self._base_url + "/serverInfo"
+        try:
+            metrics.jira_requests.inc()
+            self._session.get(url, timeout=self._timeout)
+            logger.info(f"Opened connection to {self._base_url}")
+        except requests.RequestException as error:
+            logger.warning(f"Could not warm up connection to {self._base_url}: {error}")
+
+    def close(self):
+        self._session.close()
+
     def create_headers(self):
         # Retrieve the API key secret from the environment
         basic = os.environ.get('JIRA_API_BASIC')
@@ -36,17 +243,116 @@ class JiraClient(AbstractClient):
 
 
 class KlassClient(AbstractClient):
-    def get_sectional_division_versions(self):
-        headers = {"Content-Type": content_type_json}
+    """Async client for the Klass API.
+
+    Requests share a pooled httpx.AsyncClient, so waiting on Klass does not occupy a thread.
+    """
+
+    def __init__(
+            self,
+            base_url,
+            response_cache: Optional[DiskResponseCache] = None,
+            timeout: float = 10,
+            http_client: Optional[httpx.AsyncClient] = None,
+    ):
+        super().__init__(base_url)
+        self._response_cache = response_cache
+        self._http_client = http_client or httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+        )
+        self._single_flight = AsyncSingleFlight()
+
+    async def get_sectional_division_versions(self):
         url = self._base_url + "/classifications/83"
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+        return await self._get_json(url)
 
-        return response.json()
+    async def get_latest_sectional_division_version(self, url):
+        return await self._get_json(url)
 
-    def get_latest_sectional_division_version(self, url):
-        headers = {"Content-Type": content_type_json}
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+    async def get_sectional_division_codes(self, day: date, level: Optional[int] = None):
+        """The sectional division items valid on the given day, optionally only those on one level."""
+        params = {"date": day.isoformat()}
+        if level is not None:
+            params["selectLevel"] = level
+        url = self._base_url + "/classifications/83/codesAt?" + urlencode(params)
+        return await self._get_json(url)
 
-        return response.json()
+    async def aclose(self):
+        await self._http_client.aclose()
+
+    async def _get_json(self, url):
+        """GET a JSON resource from Klass.
+
+        Concurrent requests for the same url share one upstream request. With a response cache,
+        cached responses are revalidated with conditional requests. If Klass is unavailable,
+        StaleResponse is raised with the last known good response.
+        """
+        return await self._single_flight.do(url, lambda: self._fetch_json(url))
+
+    async def _fetch_json(self, url):
+        headers = {"Content-Type": content_type_json, "Accept-Encoding": "gzip"}
+        cached = self._response_cache.get(url) if self._response_cache else None
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        try:
+            response = await self._http_client.get(url, headers=headers)
+            if response.status_code == 304 and cached is not None:
+                # Writes the cache file, keep it off the event loop
+                await asyncio.to_thread(self._response_cache.revalidated, url)
+                return cached.body
+            response.raise_for_status()
+        except httpx.HTTPError as error:
+            if cached is None:
+                raise
+            logger.warning(f"Serving last known good response for {url}: {error}")
+            raise StaleResponse(cached.body, error) from error
+
+        body = response.json()
+        if self._response_cache is not None:
+            await asyncio.to_thread(
+                self._response_cache.store,
+                url,
+                CachedResponse(
+                    body,
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                ),
+            )
+        return body
+
+
+class CachingKlassClient:
+    """KlassClient wrapper caching responses with a TTL and stale-while-revalidate, see TTLCache.
+
+    The Klass sectional division data only changes a few times a year, so requests are almost
+    always served from the cache, and refreshes happen in the background.
+    """
+
+    def __init__(self, client: KlassClient, ttl: float, stale_while_revalidate: float = 0):
+        self._client = client
+        self._cache = TTLCache(ttl, stale_while_revalidate)
+
+    async def get_sectional_division_versions(self):
+        return await self._cache.get(
+            "sectional_division_versions", self._client.get_sectional_division_versions
+        )
+
+    async def get_latest_sectional_division_version(self, url):
+        return await self._cache.get(
+            ("sectional_division_version", url),
+            lambda: self._client.get_latest_sectional_division_version(url),
+        )
+
+    async def get_sectional_division_codes(self, day: date, level: Optional[int] = None):
+        return await self._cache.get(
+            ("sectional_division_codes", day, level),
+            lambda: self._client.get_sectional_division_codes(day, level),
+        )
+
+    async def aclose(self):
+        await self._client.aclose()
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .clients import SingleFlight
+
+# Not part of what is being submitted
+IGNORED_FIELDS = {"api_version", "ui_version"}
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items() if item is not None}
+    if isinstance(value, list):
+        return sorted(
+            (_normalize(item) for item in value),
+            key=lambda item: json.dumps(item, sort_keys=True),
+        )
+    return value
+
+
+def fingerprint(model: BaseModel) -> str:
+    """A hash of the model's content, ignoring case, whitespace, list order and unset fields."""
+    content = _normalize(model.model_dump(mode="json", exclude=IGNORED_FIELDS))
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+class IdempotencyKeyReused(Exception):
+    """The idempotency key was used before for a request with different content."""
+
+
+@dataclass
+class _Completed:
+    value: Any
+    completed_at: float
+    fingerprint: Optional[str] = None
+
+
+class IdempotencyCache:
+    """Runs a call at most once per key within a time window.
+
+    Repeated calls within `window` seconds after a call succeeded get its result, and concurrent
+    calls with the same key wait for the one in flight. Failed calls are not remembered, so they can
+    be retried.
+
+    Calls can pass the fingerprint of their content. Getting the result of a call with a different
+    fingerprint raises IdempotencyKeyReused, so a reused key never returns someone else's result.
+    """
+
+    def __init__(self, window: float = 600, clock: Callable[[], float] = time.monotonic):
+        self.window = window
+        self._clock = clock
+        self._completed: "OrderedDict[Hashable, _Completed]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+
+    def _recent(self, key: Hashable):
+        with self._lock:
+            expired = self._clock() - self.window
+            while self._completed and next(iter(self._completed.values())).completed_at < expired:
+                self._completed.popitem(last=False)
+            return self._completed.get(key)
+
+    def run(
+        self, key: Hashable, function: Callable[[], Any], fingerprint: Optional[str] = None
+    ) -> Tuple[Any, bool]:
+        """The result for the key, and whether it is replayed, i.e. not from this call."""
+        executed = []
+
+        def call():
+            # Checked again here, the previous call may have completed after the check below
+            completed = self._recent(key)
+            if completed is not None:
+                return completed
+            executed.append(True)
+            completed = _Completed(function(), self._clock(), fingerprint)
+            with self._lock:
+                self._completed[key] = completed
+            return completed
+
+        completed = self._recent(key)
+        if completed is None:
+            # Concurrent calls get the completed call of the one in flight, which may be another one's
+            completed = self._single_flight.do(key, call)
+        if completed.fingerprint != fingerprint:
+            raise IdempotencyKeyReused("The idempotency key was already used for a different request")
+        return completed.value, not executed
+
+    def forget(self, key: Hashable, value: Any):
+        """Forget the result for the key, if it is still `value`, so the next call runs again."""
+        with self._lock:
+            completed = self._completed.get(key)
+            if completed is not None and completed.value == value:
+                del self._completed[key]
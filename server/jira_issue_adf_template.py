@@ -3,12 +3,13 @@ from typing import List
 import yaml
 from datetime import date
 
+from .normalize import fold_norwegian_letters
 from .project_details import ProjectDetails, ProjectUser
 
 
 def convert_display_name_to_uniform_team_name(display_team_name):
-    return (display_team_name.lower().replace("team ", "").replace(
-        " ", "-").replace("æ", "ae").replace("ø", "oe").replace("å", "aa"))
+    return fold_norwegian_letters(
+        display_team_name.lower().replace("team ", "").replace(" ", "-"))
 
 
 def get_issue_adf_dict(details: ProjectDetails):
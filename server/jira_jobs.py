@@ -0,0 +1,92 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional
+
+from requests import HTTPError
+
+from .clients import JiraClient
+from .config import logger
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass
+class JiraJob:
+    id: str
+    status: str = QUEUED
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    finished_at: Optional[float] = field(default=None, repr=False)
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "issue_key": self.result.get("key") if self.result else None,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JiraJobQueue:
+    """Creates Jira issues in the background, with a bounded pool of `workers` threads.
+
+    Jobs are kept in memory, and finished jobs are forgotten `retention` seconds after they finished.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        retention: float = 3600,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.retention = retention
+        self._clock = clock
+        self._jobs: Dict[str, JiraJob] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="jira-job")
+
+    def submit(self, client: JiraClient, issue: dict) -> JiraJob:
+        job = JiraJob(uuid.uuid4().hex)
+        with self._lock:
+            self._forget_finished()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, client, issue)
+        return job
+
+    def get(self, job_id: str) -> Optional[JiraJob]:
+        return self._jobs.get(job_id)
+
+    def _run(self, job: JiraJob, client: JiraClient, issue: dict):
+        job.status = RUNNING
+        try:
+            job.result = client.create_issue(issue)
+            job.status = DONE
+        except HTTPError as error:
+            logger.exception("Error occurred in Jira job %s: %s", job.id, error)
+            job.error = error.response.text
+            job.status = FAILED
+        except Exception as error:
+            logger.exception("Error occurred in Jira job %s: %s", job.id, error)
+            job.error = str(error)
+            job.status = FAILED
+        finally:
+            job.finished_at = self._clock()
+
+    def _forget_finished(self):
+        expired = self._clock() - self.retention
+        for job_id in [
+            job.id
+            for job in self._jobs.values()
+            if job.finished_at is not None and job.finished_at < expired
+        ]:
+            del self._jobs[job_id]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
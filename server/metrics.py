@@ -0,0 +1,44 @@
+from prometheus_client import Counter, Enum, Gauge, Histogram, Info
+
+users_directory_version = Info(
+    "dapla_start_users_directory_version",
+    "Version (content hash) of the currently served SSB users directory",
+)
+users_directory_size = Gauge(
+    "dapla_start_users_directory_size",
+    "Number of users in the currently served SSB users directory",
+)
+users_directory_loaded_timestamp = Gauge(
+    "dapla_start_users_directory_loaded_timestamp_seconds",
+    "Unix time when the currently served SSB users directory was loaded",
+)
+users_directory_reload_duration = Histogram(
+    "dapla_start_users_directory_reload_duration_seconds",
+    "Time spent loading the SSB users directory",
+)
+users_directory_reload_failures = Counter(
+    "dapla_start_users_directory_reload_failures",
+    "Number of failed attempts to reload the SSB users directory",
+)
+klass_data_age = Gauge(
+    "dapla_start_klass_data_age_seconds",
+    "Time since Klass data was last fetched or revalidated successfully",
+)
+klass_data_stale = Gauge(
+    "dapla_start_klass_data_stale",
+    "1 if the current organization information is last known good data, since Klass could not be reached, otherwise 0",
+)
+jira_requests = Counter(
+    "dapla_start_jira_requests",
+    "Number of requests sent to Jira",
+)
+jira_connections_opened = Counter(
+    "dapla_start_jira_connections_opened",
+    "Number of connections opened to Jira, compare with dapla_start_jira_requests to see how often "
+    "connections are reused",
+)
+jira_circuit_breaker_state = Enum(
+    "dapla_start_jira_circuit_breaker_state",
+    "State of the circuit breaker for requests to Jira",
+    states=["closed", "open", "half_open"],
+)
@@ -0,0 +1,21 @@
+import unicodedata
+
+_norwegian_letters = str.maketrans({"æ": "ae", "ø": "oe", "å": "aa"})
+_norwegian_letters_short = str.maketrans({"æ": "a", "ø": "o", "å": "a"})
+
+
+def fold_norwegian_letters(text: str) -> str:
+    """Lowercase and replace æ, ø and å with ae, oe and aa."""
+    return text.lower().translate(_norwegian_letters)
+
+
+def fold_diacritics(text: str, short: bool = False) -> str:
+    """Lowercase and fold a text to ASCII letters.
+
+    æ, ø and å become ae, oe and aa (or a, o and a if `short`), other letters lose their diacritics.
+    """
+    text = text.lower().translate(_norwegian_letters_short if short else _norwegian_letters)
+    if text.isascii():
+        return text
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
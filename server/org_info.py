@@ -1,18 +1,22 @@
+import asyncio
 import json
-from datetime import datetime
-from functools import reduce
+import time
+from bisect import bisect_right
+from datetime import date
+from typing import Dict, Hashable, List, Optional, Set
 
+from .cache import StaleResponse
+from .config import logger
 
-def get_klass_sectional_division(sectional_division_versions):
-    response_dict = sectional_division_versions
-    versions_list = response_dict["versions"]
-    newest_version = reduce((
-        lambda a, b:
-        a if datetime.strptime(a["validFrom"], '%Y-%m-%d').date() > datetime.strptime(b["validFrom"], '%Y-%m-%d').date()
-        else b
-    ), versions_list)
+SECTION_LEVEL = 2
+
+
+class NoVersionError(LookupError):
+    """No sectional division version is valid on the requested date."""
 
-    return newest_version["_links"]["self"]["href"]
+
+def get_klass_sectional_division(sectional_division_versions):
+    return VersionIndex(sectional_division_versions["versions"]).newest_url
 
 
 def produce_org_info(newest_version_data):
@@ -24,9 +28,219 @@ def produce_org_info(newest_version_data):
     return simplified_sections
 
 
+def produce_org_info_from_codes(codes_at):
+    """produce_org_info for a Klass codes response, fetched with selectLevel=2"""
+    return list(map(simplify_sections, codes_at["codes"]))
+
+
 def simplify_sections(section):
     return {
         "code": section["code"],
         "parent_code": section["parentCode"],
         "name": section["name"]
     }
+
+
+def simplify_item(item):
+    return {
+        "code": item["code"],
+        "parent_code": item.get("parentCode"),
+        "name": item["name"],
+        "level": item["level"],
+    }
+
+
+class OrgIndex:
+    """The classification items of a sectional division version, indexed by code and by parent.
+
+    Built once per fetched version, so looking up an item or its children is a dict lookup.
+    """
+
+    def __init__(self, classification_items):
+        self.by_code: Dict[str, dict] = {}
+        self.children: Dict[Optional[str], List[dict]] = {}
+        for item in map(simplify_item, classification_items):
+            self.by_code[item["code"]] = item
+        for item in self.by_code.values():
+            parent_code = item["parent_code"]
+            if parent_code not in self.by_code:
+                # Top level items, and items whose parent is not in the version
+                parent_code = None
+            self.children.setdefault(parent_code, []).append(item)
+        self.tree = self._subtree(None)
+
+    def _subtree(self, parent_code):
+        return [
+            {**item, "children": self._subtree(item["code"])}
+            for item in self.children.get(parent_code, [])
+        ]
+
+    def get(self, code: str) -> Optional[dict]:
+        return self.by_code.get(code)
+
+    def children_of(self, code: str) -> List[dict]:
+        return self.children.get(code, [])
+
+
+class VersionIndex:
+    """The validity intervals of sectional division versions, sorted by validFrom.
+
+    The dates are parsed once, so the version valid on a given date is found by binary search.
+    validTo is exclusive, and missing for the current version.
+    """
+
+    def __init__(self, versions):
+        intervals = sorted(
+            (
+                (
+                    date.fromisoformat(version["validFrom"]),
+                    date.fromisoformat(version["validTo"]) if version.get("validTo") else None,
+                    version["_links"]["self"]["href"],
+                )
+                for version in versions
+            ),
+            key=lambda interval: interval[0],
+        )
+        self._valid_from = [valid_from for valid_from, _, _ in intervals]
+        self._valid_to = [valid_to for _, valid_to, _ in intervals]
+        self._urls = [url for _, _, url in intervals]
+
+    @property
+    def newest_url(self) -> str:
+        return self._urls[-1]
+
+    @property
+    def newest_valid_from(self) -> date:
+        return self._valid_from[-1]
+
+    def url_at(self, day: date) -> Optional[str]:
+        """The url of the version valid on the given day, or None if no version is valid then."""
+        position = bisect_right(self._valid_from, day) - 1
+        if position < 0:
+            return None
+        valid_to = self._valid_to[position]
+        if valid_to is not None and day >= valid_to:
+            return None
+        return self._urls[position]
+
+
+class OrgInfoService:
+    """Keeps the processed sectional division versions in memory, by version url.
+
+    The sections of the newest version are fetched at startup and refreshed in the background by
+    `keep_refreshed`, so requests are served without waiting on Klass. Older versions, and the
+    OrgIndex of a version, are fetched the first time they are asked for. Older versions are kept
+    since they do not change.
+
+    Only the needed items are fetched, from the Klass codes endpoint at a date within the version.
+
+    If Klass is unavailable, the last known good data is used, and `stale` tells which data it is.
+    The newest version is kept and refreshed as usual, older versions are fetched again next time.
+    """
+
+    def __init__(self):
+        self._versions: Optional[VersionIndex] = None
+        self._org_info: Dict[str, list] = {}
+        self._indexes: Dict[str, OrgIndex] = {}
+        self._stale: Set[Hashable] = set()
+        self.loaded_at = None
+
+    @property
+    def ready(self):
+        return self._versions is not None
+
+    async def _fetch(self, key: Hashable, response):
+        """Await a Klass response, and record whether it is the last known good one."""
+        try:
+            body = await response
+        except StaleResponse as stale:
+            self._stale.add(key)
+            return stale.value
+        self._stale.discard(key)
+        return body
+
+    def _keep(self, key: Hashable, url: str) -> bool:
+        return key not in self._stale or url == self._versions.newest_url
+
+    def stale(self, day: Optional[date] = None, index: bool = False) -> bool:
+        """True if the sections (or with `index`, the OrgIndex) served for `day` are the last known good data."""
+        versions = self._versions
+        if versions is None:
+            return False
+        url = versions.newest_url if day is None else versions.url_at(day)
+        return "versions" in self._stale or ("index" if index else "sections", url) in self._stale
+
+    async def refresh(self, client):
+        versions = VersionIndex(
+            (await self._fetch("versions", client.get_sectional_division_versions()))["versions"]
+        )
+        url, day = versions.newest_url, versions.newest_valid_from
+        org_info = produce_org_info_from_codes(
+            await self._fetch(
+                ("sections", url), client.get_sectional_division_codes(day, level=SECTION_LEVEL)
+            )
+        )
+        self._org_info[url] = org_info
+        if url in self._indexes:
+            # Only kept up to date once it has been asked for
+            self._indexes[url] = OrgIndex(
+                (await self._fetch(("index", url), client.get_sectional_division_codes(day)))["codes"]
+            )
+        self._versions = versions
+        self.loaded_at = time.time()
+        return org_info
+
+    async def _version_at(self, client, day: Optional[date]):
+        """The url of the version valid on the given day (default: the newest), and a date within it.
+
+        Raises NoVersionError if no version is valid on the given day.
+        """
+        versions = self._versions
+        if versions is None:
+            await self.refresh(client)
+            versions = self._versions
+        if day is None:
+            return versions.newest_url, versions.newest_valid_from
+        url = versions.url_at(day)
+        if url is None:
+            raise NoVersionError(f"No sectional division version is valid on {day}")
+        return url, day
+
+    async def get(self, client, day: Optional[date] = None):
+        """The sections of the newest version, or of the version valid on `day`."""
+        url, day = await self._version_at(client, day)
+        org_info = self._org_info.get(url)
+        if org_info is None:
+            key = ("sections", url)
+            org_info = produce_org_info_from_codes(
+                await self._fetch(key, client.get_sectional_division_codes(day, level=SECTION_LEVEL))
+            )
+            if self._keep(key, url):
+                self._org_info[url] = org_info
+        return org_info
+
+    async def index(self, client, day: Optional[date] = None) -> OrgIndex:
+        """The OrgIndex of the newest version, or of the version valid on `day`."""
+        url, day = await self._version_at(client, day)
+        org_index = self._indexes.get(url)
+        if org_index is None:
+            key = ("index", url)
+            org_index = OrgIndex(
+                (await self._fetch(key, client.get_sectional_division_codes(day)))["codes"]
+            )
+            if self._keep(key, url):
+                self._indexes[url] = org_index
+        return org_index
+
+    async def keep_refreshed(self, client, interval: float, retry_interval: float = 10):
+        """Refresh every `interval` seconds, until cancelled.
+
+        After a failure, or while the data is stale, the next refresh is after `retry_interval` seconds.
+        """
+        while True:
+            try:
+                await self.refresh(client)
+                await asyncio.sleep(min(interval, retry_interval) if self.stale() else interval)
+            except Exception as error:
+                logger.error(f"Error occurred while refreshing organization information: {error}")
+                await asyncio.sleep(min(interval, retry_interval))
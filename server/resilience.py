@@ -0,0 +1,213 @@
+"""Retries and circuit breaking for calls to upstream services."""
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Collection, Optional
+
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from .config import logger
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """The circuit breaker is open, the call was not attempted."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Circuit breaker is open, retry in {retry_after:.0f} seconds")
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str], clock: Callable[[], float] = time.time) -> Optional[float]:
+    """Seconds to wait according to a Retry-After header, which is either seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - clock())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_connect_failure(error: requests.RequestException) -> bool:
+    """True if the request failed while connecting, i.e. it was never sent."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.ConnectionError) or not error.args:
+        return False
+    reason = error.args[0]
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    # Includes NameResolutionError
+    return isinstance(reason, NewConnectionError)
+
+
+class RetryPolicy:
+    """Capped exponential backoff with full jitter.
+
+    The delay before retry number `n` (counting from 0) is random between 0 and
+    min(max_delay, base_delay * 2 ** n). If the response has a Retry-After header, it is honored
+    instead, unless it asks to wait more than `max_retry_after` seconds, which gives up.
+    """
+
+    def __init__(
+        self,
+        attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 10,
+        max_retry_after: float = 60,
+        retry_statuses: Collection[int] = (429, 503),
+        sleep: Callable[[float], None] = time.sleep,
+        jitter: Callable[[float, float], float] = random.uniform,
+    ):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.retry_statuses = retry_statuses
+        self.sleep = sleep
+        self._jitter = jitter
+
+    def delay(self, retry: int, retry_after: Optional[float] = None) -> Optional[float]:
+        """Seconds to wait before the given retry, or None to give up."""
+        if retry >= self.attempts - 1:
+            return None
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_retry_after else None
+        return self._jitter(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+
+class CircuitBreaker:
+    """Fails fast while an upstream service is unhealthy.
+
+    After `failure_threshold` failed calls in a row the breaker opens, and calls fail with
+    CircuitOpenError without being attempted. After `reset_timeout` seconds it is half open, and
+    one trial call is let through: the breaker closes if it succeeds, and opens again if it fails.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        clock: Callable[[], float] = time.monotonic,
+        on_state_change: Optional[Callable[[str], None]] = None,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._on_state_change = on_state_change
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self._set_state(CLOSED)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self._set_state(HALF_OPEN)
+        return self._state
+
+    def _set_state(self, state: str):
+        if state != self._state:
+            logger.warning(f"Circuit breaker is {state}")
+        self._state = state
+        if self._on_state_change:
+            self._on_state_change(state)
+
+    def before_call(self):
+        """Raises CircuitOpenError unless a call may be attempted."""
+        with self._lock:
+            state = self._current_state()
+            if state == OPEN:
+                raise CircuitOpenError(self.reset_timeout - (self._clock() - self._opened_at))
+            if state == HALF_OPEN:
+                if self._trial_in_flight:
+                    raise CircuitOpenError(0)
+                self._trial_in_flight = True
+
+    def release(self):
+        """Record that a call ended without an outcome for the upstream service, e.g. a local error."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+                self._set_state(OPEN)
+
+
+def send_with_retries(
+    send: Callable[[], requests.Response],
+    retry: RetryPolicy,
+    breaker: Optional[CircuitBreaker] = None,
+) -> requests.Response:
+    """Send a request, retrying failed connects and responses with a status in `retry.retry_statuses`.
+
+    Failures after the connection was made (timeouts, aborted connections) are not retried, since the
+    request may have been sent and processed.
+    Connection failures, timeouts and 5xx/429 responses count as failures for the circuit breaker.
+    Other exceptions do not count, but still end a half open breaker's trial call.
+    """
+    if breaker:
+        breaker.before_call()
+    try:
+        response = _send_with_retries(send, retry)
+    except requests.RequestException:
+        if breaker:
+            breaker.record_failure()
+        raise
+    except BaseException:
+        if breaker:
+            breaker.release()
+        raise
+
+    if breaker:
+        if response.status_code >= 500 or response.status_code == 429:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    return response
+
+
+def _send_with_retries(send: Callable[[], requests.Response], retry: RetryPolicy) -> requests.Response:
+    retries = 0
+    while True:
+        try:
+            response = send()
+        except requests.RequestException as error:
+            delay = retry.delay(retries) if is_connect_failure(error) else None
+            if delay is None:
+                raise
+            logger.warning(f"Retrying in {delay:.1f} seconds after connection error: {error}")
+        else:
+            if response.status_code not in retry.retry_statuses:
+                return response
+            delay = retry.delay(retries, parse_retry_after(response.headers.get("Retry-After")))
+            if delay is None:
+                return response
+            logger.warning(f"Retrying in {delay:.1f} seconds after status {response.status_code}")
+        retry.sleep(delay)
+        retries += 1
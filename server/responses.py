@@ -0,0 +1,74 @@
+import json
+from typing import Iterable, Optional
+
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+
+content_type_json = "application/json"
+content_type_ndjson = "application/x-ndjson"
+
+
+def etag_matches(if_none_match: Optional[str], *etags: str) -> bool:
+    """Check an If-None-Match header against any of the ETags, using weak comparison (RFC 7232)."""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or any(
+        candidate.removeprefix("W/") in etags for candidate in candidates
+    )
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """Check if an Accept-Encoding header allows a gzip encoded response."""
+    if not accept_encoding:
+        return False
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            quality = params.strip().lower()
+            return quality.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def pre_encoded_response(
+    body: bytes,
+    gzip_body: bytes,
+    etag: str,
+    gzip_etag: str,
+    if_none_match: Optional[str] = None,
+    accept_encoding: Optional[str] = None,
+    media_type: str = content_type_json,
+) -> Response:
+    """Respond with an already encoded body, honouring If-None-Match and Accept-Encoding.
+
+    The identity and gzip encoded bodies have different ETags. A request is not modified if it has
+    either of them, since both are current.
+    """
+    gzip_encoded = accepts_gzip(accept_encoding)
+    headers = {
+        "ETag": gzip_etag if gzip_encoded else etag,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "no-cache",
+    }
+
+    if etag_matches(if_none_match, etag, gzip_etag):
+        return Response(status_code=304, headers=headers)
+
+    if gzip_encoded:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=gzip_body, media_type=media_type, headers=headers)
+
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+def accepts_ndjson(accept: Optional[str]) -> bool:
+    return bool(accept) and content_type_ndjson in accept
+
+
+def ndjson_response(rows: Iterable[dict], headers: Optional[dict] = None) -> StreamingResponse:
+    """Stream rows as newline delimited JSON, encoding one row at a time."""
+    lines = (
+        json.dumps(row, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        for row in rows
+    )
+    return StreamingResponse(lines, media_type=content_type_ndjson, headers=headers)
@@ -0,0 +1,325 @@
+import base64
+import binascii
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+from array import array
+from bisect import bisect_right
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from pydantic import BaseModel, Field
+
+from .config import logger
+from .user_search import PrefixIndex, TrigramIndex
+
+USER_FIELDS = ("name", "email", "email_short")
+
+
+class User:
+    """An immutable user record.
+
+    Records use __slots__ to keep the per-user overhead of large directories low. The strings are
+    not interned, since they are unique per user, and interning would only add to the memory use.
+    """
+
+    __slots__ = USER_FIELDS
+
+    def __init__(self, name: str, email: str, email_short: str):
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "email", email)
+        object.__setattr__(self, "email_short", email_short)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, User):
+            return NotImplemented
+        return (self.name, self.email, self.email_short) == (
+            other.name,
+            other.email,
+            other.email_short,
+        )
+
+    def __hash__(self):
+        return hash((self.name, self.email, self.email_short))
+
+    def __repr__(self):
+        return f"User(name={self.name!r}, email={self.email!r}, email_short={self.email_short!r})"
+
+    def as_dict(self, fields: Iterable[str] = USER_FIELDS):
+        return {field: getattr(self, field) for field in fields}
+
+
+def parse_fields(fields: Optional[str]) -> Tuple[str, ...]:
+    """Resolve a comma separated `fields` parameter to a tuple of known user fields.
+
+    The tuple is always ordered as USER_FIELDS, and unknown or missing fields fall back to all fields.
+    """
+    requested = set([f.strip() for f in fields.split(",")]) if fields else set()
+    selected = tuple(field for field in USER_FIELDS if field in requested)
+    return selected if selected else USER_FIELDS
+
+
+def user_from_row(row) -> Optional[User]:
+    """Convert a row (dict) from the SSB users export to a User, or None if the user is not applicable."""
+    return user_from_values(row["userPrincipalName"], row["displayName"], row["mail"])
+
+
+def user_from_values(principal: str, display_name: str, mail: str) -> Optional[User]:
+    """Create a User from the columns of the SSB users export, or None if the user is not applicable.
+
+    Only keep users that:
+    * Has a valid first- and surname
+    * Has an active account
+    * Has a short email starting with 3 letters OR has a "kons" prefix
+    """
+    display_name = display_name.strip()
+    principal = principal.strip()
+
+    # Skip users without proper name
+    if len(display_name) == 0:
+        return None
+
+    # Only keep accounts with principals with "3-letter" and those starting with "kons"
+    if not (
+        len(principal) > 4 and (principal[3] == "@" or principal.startswith("kons"))
+    ):
+        return None
+
+    return User(
+        name=display_name.replace("  ", ", ", 1),
+        email=str(mail).lower(),
+        email_short=principal,
+    )
+
+
+def encode_cursor(principal: str) -> str:
+    return base64.urlsafe_b64encode(principal.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> str:
+    """Decode a pagination cursor. Raises ValueError if the cursor is malformed."""
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        return base64.b64decode(cursor + padding, altchars=b"-_", validate=True).decode("utf-8")
+    except (binascii.Error, UnicodeDecodeError) as error:
+        raise ValueError(f"Invalid cursor: {cursor}") from error
+
+
+class UserLookupRequest(BaseModel):
+    principals: List[str] = Field(max_length=1000)
+
+
+@dataclass(frozen=True)
+class EncodedUsers:
+    """A pre-encoded JSON list of users for one field projection."""
+
+    body: bytes
+    gzip_body: bytes
+    etag: str
+
+    @property
+    def gzip_etag(self) -> str:
+        """The gzip encoded body is a different representation, with its own strong ETag."""
+        return self.etag[:-1] + '-gz"'
+
+
+def encode_json(content) -> bytes:
+    # Same encoding as FastAPI's default JSONResponse
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+class UserDirectory:
+    """Immutable, in-memory snapshot of the applicable SSB users."""
+
+    def __init__(
+        self,
+        users: Iterable[User],
+        version: str = "",
+        source: Optional[str] = None,
+        mapped: bool = False,
+    ):
+        # Immutable sequences (e.g. a memory-mapped snapshot) are kept as is, anything else is copied
+        if isinstance(users, list) or not isinstance(users, Sequence):
+            users = tuple(users)
+        self._users = users
+        self.version = version
+        self.source = source
+        self.mapped = mapped
+        self._encoded = {}
+
+    def __len__(self):
+        return len(self._users)
+
+    def __iter__(self):
+        return iter(self._users)
+
+    @property
+    def users(self) -> Sequence[User]:
+        return self._users
+
+    def as_dicts(self, fields: Iterable[str] = USER_FIELDS) -> List[dict]:
+        fields = tuple(fields)
+        return [user.as_dict(fields) for user in self._users]
+
+    def encoded(self, fields: Tuple[str, ...] = USER_FIELDS) -> EncodedUsers:
+        """The JSON encoded list of users for the given projection, encoded once per snapshot."""
+        encoded = self._encoded.get(fields)
+        if encoded is None:
+            body = encode_json(self.as_dicts(fields))
+            encoded = EncodedUsers(
+                body=body,
+                gzip_body=gzip.compress(body, compresslevel=6, mtime=0),
+                etag=f'"{self.version}-{"+".join(fields)}"',
+            )
+            self._encoded[fields] = encoded
+        return encoded
+
+    @cached_property
+    def prefix_index(self) -> PrefixIndex:
+        return PrefixIndex(self._users)
+
+    @cached_property
+    def sorted_by_principal(self) -> Tuple[Tuple[str, ...], array]:
+        """Positions of the users ordered by lowercase principal, with the sorted principals for bisecting.
+
+        Positions rather than users are kept, so a memory-mapped snapshot is only decoded on access.
+        """
+        entries = sorted(
+            (user.email_short.lower(), position) for position, user in enumerate(self._users)
+        )
+        return (
+            tuple(principal for principal, _ in entries),
+            array("I", (position for _, position in entries)),
+        )
+
+    def page(
+        self, after: Optional[str] = None, limit: Optional[int] = None
+    ) -> Tuple[Sequence[User], Optional[str]]:
+        """A page of users ordered by principal, starting after the principal `after`.
+
+        Returns the users and the principal to continue after, or None if this is the last page.
+        The ordering does not depend on the export, so pages stay consistent across reloads.
+        Principals must be unique (ignoring case), since the page continues after every user with
+        the principal `after`.
+        """
+        principals, positions = self.sorted_by_principal
+        start = bisect_right(principals, after.lower()) if after else 0
+        end = len(positions) if limit is None else min(start + limit, len(positions))
+        page = tuple(self._users[position] for position in positions[start:end])
+        next_after = principals[end - 1] if page and end < len(positions) else None
+        return page, next_after
+
+    @cached_property
+    def by_principal(self) -> Dict[str, int]:
+        """Position of the user with each lowercase principal."""
+        return {user.email_short.lower(): position for position, user in enumerate(self._users)}
+
+    def lookup(self, principals: Iterable[str]) -> Tuple[List[User], List[str]]:
+        """Resolve principals (email_short) to users. Returns the found users and the unknown principals."""
+        found, unknown = [], []
+        by_principal = self.by_principal
+        for principal in principals:
+            position = by_principal.get(principal.strip().lower())
+            if position is None:
+                unknown.append(principal)
+            else:
+                found.append(self._users[position])
+        return found, unknown
+
+    @cached_property
+    def trigram_index(self) -> TrigramIndex:
+        return TrigramIndex(self._users)
+
+    def search(self, query: str, limit: int = 10) -> List[User]:
+        """Typeahead search on name, email_short and mail prefixes."""
+        return self.prefix_index.search(query, limit)
+
+    def fuzzy_search(self, query: str, limit: int = 10) -> List[User]:
+        """Diacritic- and typo-tolerant search, ranked by similarity."""
+        return self.trigram_index.search(query, limit)
+
+    def warm(self):
+        """Build the search indexes and pre-encode the responses for every possible field projection."""
+        self.by_principal
+        self.sorted_by_principal
+        self.prefix_index
+        self.trigram_index
+        for size in range(1, len(USER_FIELDS) + 1):
+            for fields in itertools.combinations(USER_FIELDS, size):
+                self.encoded(fields)
+
+
+def unique_users(users: Iterable[User], source: Optional[str] = None) -> List[User]:
+    """Users ordered by principal, with one user per principal (ignoring case).
+
+    Of users with the same principal the last one is kept, as SqliteUserStore does, so both ways of
+    serving an export give the same users in the same order.
+    """
+    by_principal = {}
+    count = 0
+    for user in users:
+        by_principal[user.email_short.lower()] = user
+        count += 1
+    if count > len(by_principal):
+        logger.warning(
+            f"Dropped {count - len(by_principal)} users with duplicate principals from {source or 'the export'}"
+        )
+    return [by_principal[principal] for principal in sorted(by_principal)]
+
+
+def parse_user_export(content: bytes, source: Optional[str] = None) -> UserDirectory:
+    """Parse and filter the raw bytes of an SSB users export (CSV).
+
+    The users are ordered by principal, without duplicates, see unique_users. The version of the
+    resulting directory is derived from the content, so identical exports always get the same
+    version, also across processes.
+    """
+    text = content.decode("utf-8-sig")
+    reader = csv.reader(io.StringIO(text))
+    header = next(reader, [])
+    principal, display_name, mail = columns = tuple(
+        header.index(column) for column in ("userPrincipalName", "displayName", "mail")
+    )
+    width = max(columns) + 1
+    users = unique_users(
+        (
+            user
+            for user in (
+                user_from_values(row[principal], row[display_name], row[mail])
+                for row in reader
+                if len(row) >= width
+            )
+            if user is not None
+        ),
+        source,
+    )
+    version = hashlib.sha256(content).hexdigest()[:16]
+
+    return UserDirectory(users, version=version, source=source)
+
+
+def load_user_directory(path: str) -> UserDirectory:
+    """Load the users at the given path.
+
+    The path is either an SSB users export (CSV), which is parsed and filtered, or a binary snapshot
+    compiled with `python -m server.user_snapshot`, which is memory-mapped.
+    """
+    from .user_ingest import ingest_user_export
+    from .user_snapshot import is_user_snapshot, map_user_snapshot
+
+    if is_user_snapshot(path):
+        directory = map_user_snapshot(path)
+    else:
+        directory = ingest_user_export(path)
+
+    logger.info(f"Loaded {len(directory)} users from {path} (version {directory.version})")
+    return directory
@@ -0,0 +1,137 @@
+"""Chunked and parallel ingestion of the SSB users export.
+
+The export is read from one open file in chunks of about a fixed size, ending at line boundaries outside
+quoted fields, so parsing needs a constant amount of memory on top of the resulting directory. Each
+chunk is transposed to columns, and the filtering rules of the users export are applied column by column
+instead of row by row. Chunks of large exports are parsed in parallel by a process pool.
+
+The export may be replaced while it is read. The version is the hash of the bytes that were parsed, and
+a file that is modified in place while it is read is rejected rather than loaded half-way.
+"""
+import csv
+import hashlib
+import io
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from .user_directory import User, UserDirectory, unique_users
+
+EXPORT_COLUMNS = ("userPrincipalName", "displayName", "mail")
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+UserValues = Tuple[str, str, str]
+
+
+def filter_columns(principals, display_names, mails) -> List[UserValues]:
+    """Apply the users export filtering rules to columns of values.
+
+    Returns (name, email, email_short) for the users to keep, see user_directory.user_from_values.
+    """
+    principals = list(map(str.strip, principals))
+    display_names = list(map(str.strip, display_names))
+    keep = [
+        len(name) > 0 and len(principal) > 4 and (principal[3] == "@" or principal.startswith("kons"))
+        for principal, name in zip(principals, display_names)
+    ]
+    names = [name.replace("  ", ", ", 1) for name in compress(display_names, keep)]
+    emails = [mail.lower() for mail in compress(mails, keep)]
+    return list(zip(names, emails, compress(principals, keep)))
+
+
+def _parse_lines(text: str, columns: Tuple[int, int, int]) -> List[UserValues]:
+    width = max(columns) + 1
+    rows = [row for row in csv.reader(io.StringIO(text)) if len(row) >= width]
+    if not rows:
+        return []
+    table = list(zip(*rows))
+    return filter_columns(*(table[column] for column in columns))
+
+
+def _read_header(file: BinaryIO) -> Tuple[Tuple[int, int, int], bytes]:
+    """Column positions of the export columns, and the header line."""
+    line = file.readline()
+    header = next(csv.reader([line.decode("utf-8-sig")]), [])
+    return tuple(header.index(column) for column in EXPORT_COLUMNS), line
+
+
+def read_chunks(file: BinaryIO, chunk_size: int) -> Iterator[bytes]:
+    """Read the rest of a CSV file in chunks of about `chunk_size` bytes.
+
+    Chunks end at line boundaries that are not inside a quoted field, so every chunk holds whole
+    rows. Since quotes inside quoted fields are doubled, a chunk ends inside a quoted field exactly
+    when it has an odd number of quotes.
+    """
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        chunk += file.readline()
+        quotes = chunk.count(b'"')
+        while quotes % 2:
+            line = file.readline()
+            if not line:
+                break
+            chunk += line
+            quotes += line.count(b'"')
+        yield chunk
+
+
+def _parse_chunk(chunk: bytes, columns: Tuple[int, int, int]) -> List[UserValues]:
+    return _parse_lines(chunk.decode("utf-8"), columns)
+
+
+def _file_signature(file: BinaryIO):
+    stat = os.fstat(file.fileno())
+    return stat.st_mtime_ns, stat.st_ino, stat.st_size
+
+
+def ingest_user_export(
+    path: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: Optional[int] = None,
+) -> UserDirectory:
+    """Load and filter the users export at the given path, chunk by chunk.
+
+    Exports larger than PARALLEL_THRESHOLD are parsed by a process pool with `workers` processes
+    (default: one per CPU). Set `workers` to 1 to always parse in this process. The result is the
+    same as user_directory.parse_user_export on the file content, including the version.
+    Raises ValueError if the file is modified while it is read.
+    """
+    with open(path, mode="rb") as file:
+        signature = _file_signature(file)
+        columns, header = _read_header(file)
+        digest = hashlib.sha256(header)
+        if workers is None:
+            workers = (os.cpu_count() or 1) if signature[2] >= PARALLEL_THRESHOLD else 1
+
+        def chunks():
+            for chunk in read_chunks(file, chunk_size):
+                digest.update(chunk)
+                yield chunk
+
+        users = []
+        if workers > 1:
+            # Spawn fresh workers, forking a process with running threads is not safe
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                # Bounds the number of chunks read ahead of the parsing
+                pending = deque()
+                for chunk in chunks():
+                    pending.append(executor.submit(_parse_chunk, chunk, columns))
+                    if len(pending) > 2 * workers:
+                        users.extend(User(*user) for user in pending.popleft().result())
+                while pending:
+                    users.extend(User(*user) for user in pending.popleft().result())
+        else:
+            for chunk in chunks():
+                users.extend(User(*user) for user in _parse_chunk(chunk, columns))
+
+        if _file_signature(file) != signature:
+            raise ValueError(f"{path} was modified while it was read")
+
+    return UserDirectory(unique_users(users, path), version=digest.hexdigest()[:16], source=path)
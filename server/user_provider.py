@@ -0,0 +1,147 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Optional
+
+import requests
+
+from . import metrics
+from .config import logger
+from .user_directory import UserDirectory, load_user_directory, parse_user_export
+
+
+class FileUserSource:
+    """Users export (or compiled snapshot) read from a local file.
+
+    Changes are detected by the file's mtime, inode and size.
+    """
+
+    def __init__(self, path: str):
+        self.location = path
+        self._signature = None
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.location)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_ino, stat.st_size
+
+    def fetch(self, force: bool = False) -> Optional[UserDirectory]:
+        """Load the users, or return None if the file is unchanged since the last fetch (unless `force`)."""
+        signature = self._file_signature()
+        if not force and signature == self._signature:
+            return None
+        directory = load_user_directory(self.location)
+        self._signature = signature
+        return directory
+
+
+class HttpUserSource:
+    """Users export downloaded from an HTTP(S) URL.
+
+    Polling uses conditional requests (If-None-Match/If-Modified-Since), so the export is only
+    downloaded and parsed when it has changed.
+    """
+
+    def __init__(self, url: str, timeout: float = 30):
+        self.location = url
+        self._timeout = timeout
+        self._session = requests.Session()
+        self._etag = None
+        self._last_modified = None
+
+    def fetch(self, force: bool = False) -> Optional[UserDirectory]:
+        """Download the users, or return None if the export is unchanged since the last fetch (unless `force`)."""
+        headers = {}
+        if not force:
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified:
+                headers["If-Modified-Since"] = self._last_modified
+
+        response = self._session.get(self.location, headers=headers, timeout=self._timeout)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+
+        directory = parse_user_export(response.content, source=self.location)
+        logger.info(f"Downloaded {len(directory)} users from {self.location} (version {directory.version})")
+        self._etag = response.headers.get("ETag")
+        self._last_modified = response.headers.get("Last-Modified")
+        return directory
+
+
+def user_source(location: str):
+    """The source for SSB_USERS_SOURCE, which is either a path or an HTTP(S) URL."""
+    if location.startswith(("http://", "https://")):
+        return HttpUserSource(location)
+    return FileUserSource(location)
+
+
+class UserDirectoryProvider:
+    """Holds the currently served UserDirectory.
+
+    The directory is loaded at startup (or lazily on first use). After that, `watch` polls the
+    source and swaps in a freshly parsed directory when it has changed. Parsing happens off the
+    request path, and readers always get a complete snapshot since the swap is a single reference
+    assignment. If the source is unavailable, the last loaded directory is kept.
+    """
+
+    def __init__(self, location: str):
+        self.source = user_source(location)
+        self._directory: Optional[UserDirectory] = None
+        self._lock = threading.Lock()
+
+    @property
+    def location(self) -> str:
+        return self.source.location
+
+    def load(self) -> UserDirectory:
+        with self._lock:
+            return self._reload(force=True)
+
+    def _reload(self, force: bool) -> Optional[UserDirectory]:
+        started = time.perf_counter()
+        directory = self.source.fetch(force=force)
+        if directory is None:
+            return None
+        directory = self._serve(directory)
+        metrics.users_directory_reload_duration.observe(time.perf_counter() - started)
+
+        self._directory = directory
+        metrics.users_directory_version.info({"version": directory.version})
+        metrics.users_directory_size.set(len(directory))
+        metrics.users_directory_loaded_timestamp.set(time.time())
+        return directory
+
+    def _serve(self, directory: UserDirectory):
+        """Prepare a freshly loaded directory for serving."""
+        if not directory.mapped:
+            # Mapped snapshots build their indexes lazily, so cold start only needs to map the file
+            directory.warm()
+        return directory
+
+    def get(self) -> UserDirectory:
+        directory = self._directory
+        if directory is None:
+            directory = self.load()
+        return directory
+
+    def reload_if_changed(self) -> bool:
+        """Reload the directory if the source has changed. Returns True if it was reloaded."""
+        with self._lock:
+            try:
+                return self._reload(force=False) is not None
+            except Exception as error:
+                # Keep serving the last successfully loaded snapshot
+                metrics.users_directory_reload_failures.inc()
+                logger.exception(f"Failed to reload users from {self.location}: {error}")
+                return False
+
+    async def watch(self, interval: float):
+        """Poll the source for changes every `interval` seconds, until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.reload_if_changed)
@@ -0,0 +1,182 @@
+import heapq
+import re
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from operator import itemgetter
+from typing import Iterable, List, Sequence, Set, Tuple
+
+from .normalize import fold_diacritics
+
+_token_separators = re.compile(r"[\s,]+")
+
+
+def search_terms(text: str) -> List[str]:
+    """Split a text into lowercase search terms."""
+    return [term for term in _token_separators.split(text.strip().lower()) if term]
+
+
+def user_keys(user) -> List[str]:
+    """The keys a user can be found by: the display name, email_short, mail and the tokens of name and mail."""
+    name = user.name.lower()
+    keys = [name, user.email_short.lower(), user.email]
+    keys.extend(search_terms(name))
+    keys.extend(part for part in user.email.partition("@")[0].split(".") if part)
+    return list(dict.fromkeys(keys))
+
+
+class PrefixIndex:
+    """Sorted array of (key, user position) used for prefix search with bisect."""
+
+    def __init__(self, users: Sequence):
+        self._users = users
+        entries = sorted(
+            (key, position)
+            for position, user in enumerate(users)
+            for key in user_keys(user)
+        )
+        self._keys = [key for key, _ in entries]
+        self._positions = [position for _, position in entries]
+        self._user_keys = [None] * len(users)
+
+    def _keys_of(self, position: int) -> List[str]:
+        keys = self._user_keys[position]
+        if keys is None:
+            keys = self._user_keys[position] = user_keys(self._users[position])
+        return keys
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """Find users where every term of the query is a prefix of one of the user's keys.
+
+        The longest term is looked up in the index, and the other terms filter those candidates.
+        Matches are returned in key order, with at most `limit` users.
+        """
+        terms = search_terms(query)
+        if not terms or limit <= 0:
+            return []
+        terms.sort(key=len, reverse=True)
+        lookup, rest = terms[0], terms[1:]
+
+        found = []
+        seen = set()
+        for i in range(bisect_left(self._keys, lookup), len(self._keys)):
+            if not self._keys[i].startswith(lookup):
+                break
+            position = self._positions[i]
+            if position in seen:
+                continue
+            seen.add(position)
+            keys = self._keys_of(position)
+            if all(any(key.startswith(term) for key in keys) for term in rest):
+                found.append(self._users[position])
+                if len(found) >= limit:
+                    break
+        return found
+
+
+def trigrams(text: str) -> Set[str]:
+    """Character trigrams of each word in a text, with word boundaries marked by spaces."""
+    return {
+        padded[i : i + 3]
+        for padded in [f"  {word} " for word in text.split()]
+        for i in range(len(padded) - 2)
+    }
+
+
+def fuzzy_keys(user) -> List[str]:
+    """Folded keys used for fuzzy search: the display name and the local parts of email_short and mail.
+
+    Both the ae/oe/aa and the a/o/a folding of æ, ø and å are kept, so "Åberg" is found by both "aaberg" and "aberg".
+    """
+    texts = [
+        user.name.replace(",", " "),
+        user.email_short.partition("@")[0],
+        user.email.partition("@")[0].replace(".", " "),
+    ]
+    keys = [fold_diacritics(text) for text in texts]
+    keys.extend(fold_diacritics(text, short=True) for text in texts)
+    return list(dict.fromkeys(" ".join(key.split()) for key in keys))
+
+
+def query_trigrams(query: str) -> Set[str]:
+    return trigrams(" ".join(fold_diacritics(query).replace(",", " ").split()))
+
+
+def fuzzy_score(query_grams: Set[str], user) -> Tuple[float, float]:
+    """Best (query coverage, Dice coefficient) between the query and one of the user's keys.
+
+    Coverage is the share of the query trigrams found in the key, so short queries are not
+    penalized for matching only part of a long name. The Dice coefficient breaks ties in favour
+    of keys close to the query in length.
+    """
+    best = (0.0, 0.0)
+    for key in fuzzy_keys(user):
+        key_grams = trigrams(key)
+        shared = len(query_grams & key_grams)
+        score = (
+            shared / len(query_grams),
+            2 * shared / (len(query_grams) + len(key_grams)),
+        )
+        best = max(best, score)
+    return best
+
+
+def rank_fuzzy_matches(
+    query_grams: Set[str], candidates: Iterable, limit: int, min_coverage: float = 0.4
+) -> list:
+    """Score candidate users against the query and return the `limit` best matches."""
+    scored = []
+    for position, user in enumerate(candidates):
+        coverage, similarity = fuzzy_score(query_grams, user)
+        if coverage >= min_coverage:
+            scored.append((-coverage, -similarity, user.name, position, user))
+    return [scored_user[-1] for scored_user in heapq.nsmallest(limit, scored, key=lambda s: s[:4])]
+
+
+class TrigramIndex:
+    """Trigram index over folded user keys, used for diacritic- and typo-tolerant search.
+
+    A query is resolved by counting shared trigrams per user, starting with the rarest trigrams and
+    skipping trigrams that are too common to be selective. Only the `max_candidates` users with the most
+    shared trigrams are scored, so the cost of a query is bounded regardless of the directory size.
+    """
+
+    def __init__(
+        self,
+        users: Sequence,
+        max_candidates: int = 100,
+        max_posting_ratio: float = 0.2,
+        min_coverage: float = 0.4,
+    ):
+        self._users = users
+        self._max_candidates = max_candidates
+        self._max_posting_length = max(50, int(len(users) * max_posting_ratio))
+        self._min_coverage = min_coverage
+        postings = defaultdict(list)
+        for position, user in enumerate(users):
+            for gram in trigrams(" ".join(fuzzy_keys(user))):
+                postings[gram].append(position)
+        self._postings = {gram: array("I", positions) for gram, positions in postings.items()}
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """Find the users best matching the query, ranked by trigram similarity."""
+        query_grams = query_trigrams(query)
+        if not query_grams or limit <= 0:
+            return []
+
+        postings = sorted(
+            (self._postings[gram] for gram in query_grams if gram in self._postings),
+            key=len,
+        )
+        selective = [p for p in postings if len(p) <= self._max_posting_length]
+        counts = Counter()
+        for positions in selective or postings[:1]:
+            counts.update(positions)
+
+        candidates = heapq.nlargest(self._max_candidates, counts.items(), key=itemgetter(1))
+        return rank_fuzzy_matches(
+            query_grams,
+            (self._users[position] for position, _ in candidates),
+            limit,
+            self._min_coverage,
+        )
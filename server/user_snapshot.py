@@ -0,0 +1,127 @@
+"""Compact binary snapshots of the SSB users directory.
+
+A snapshot holds the users that remain after applying the filtering rules of the users export, so
+the server only has to memory-map it instead of parsing the CSV. All worker processes mapping the
+same file share one copy in the page cache.
+
+Layout (little endian):
+* magic (8 bytes) and user count (uint32)
+* version (16 bytes ascii), the content hash of the export the snapshot was compiled from
+* offset table: 3 * count + 1 uint32 offsets into the string blob
+* string blob: utf-8 encoded name, email and email_short of each user
+
+Compile a snapshot with:
+
+    python -m server.user_snapshot users-export.csv users.snapshot
+
+The snapshot is written to a temporary file and renamed into place, so a running server never maps a
+partially written file.
+"""
+import argparse
+import mmap
+import os
+import struct
+import tempfile
+from typing import Sequence
+
+from .config import logger
+from .user_directory import USER_FIELDS, User, UserDirectory
+from .user_ingest import ingest_user_export
+
+MAGIC = b"DSUSERS1"
+_header = struct.Struct("<8sI16s")
+_offset = struct.Struct("<I")
+_record_offsets = struct.Struct(f"<{len(USER_FIELDS) + 1}I")
+
+
+def is_user_snapshot(path: str) -> bool:
+    with open(path, mode="rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def write_user_snapshot(directory: UserDirectory, path: str):
+    """Write the users of a directory to a snapshot file at the given path, atomically."""
+    blob = bytearray()
+    offsets = [0]
+    for user in directory:
+        for field in USER_FIELDS:
+            blob += getattr(user, field).encode("utf-8")
+            offsets.append(len(blob))
+
+    version = directory.version.encode("ascii")[:16].ljust(16, b"\0")
+    folder = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=folder, delete=False) as file:
+        file.write(_header.pack(MAGIC, len(directory), version))
+        file.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        file.write(blob)
+    os.replace(file.name, path)
+
+
+class MappedUsers(Sequence):
+    """Read-only sequence of users decoded on access from a memory-mapped snapshot."""
+
+    def __init__(self, data: mmap.mmap, count: int):
+        self._data = data
+        self._count = count
+        self._offsets = _header.size
+        self._blob = _header.size + (len(USER_FIELDS) * count + 1) * _offset.size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self[i] for i in range(*index.indices(self._count)))
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("user index out of range")
+
+        offsets = _record_offsets.unpack_from(
+            self._data, self._offsets + index * len(USER_FIELDS) * _offset.size
+        )
+        name, email, email_short = (
+            self._data[self._blob + start : self._blob + end].decode("utf-8")
+            for start, end in zip(offsets, offsets[1:])
+        )
+        return User(name=name, email=email, email_short=email_short)
+
+
+def map_user_snapshot(path: str) -> UserDirectory:
+    """Memory-map a snapshot file (read-only) as a UserDirectory."""
+    with open(path, mode="rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, count, version = _header.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a users snapshot")
+
+    return UserDirectory(
+        MappedUsers(data, count),
+        version=version.rstrip(b"\0").decode("ascii"),
+        source=path,
+        mapped=True,
+    )
+
+
+def compile_user_snapshot(export_path: str, snapshot_path: str) -> UserDirectory:
+    """Parse and filter a users export (CSV) and write the result as a snapshot."""
+    directory = ingest_user_export(export_path)
+    write_user_snapshot(directory, snapshot_path)
+
+    logger.info(f"Compiled {len(directory)} users from {export_path} to {snapshot_path}")
+    return directory
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Compile an SSB users export (CSV) to a binary snapshot that can be used as SSB_USERS_SOURCE"
+    )
+    parser.add_argument("export", help="Path to the users export (CSV)")
+    parser.add_argument("snapshot", help="Path to write the snapshot to")
+    parsed = parser.parse_args(args)
+    compile_user_snapshot(parsed.export, parsed.snapshot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+"""SQLite backed store for the SSB users directory.
+
+An alternative to keeping the whole directory in memory: the filtered users are kept in a local SQLite
+database with FTS5 indexes over names and principals, and are queried through a small connection pool.
+Imports of a new export only write the rows that changed, and the database (with the version of the
+imported export) persists across restarts.
+
+Enable it by setting SSB_USERS_DB to the path of the database file, or import an export manually with:
+
+    python -m server.user_store users-export.csv users.db
+"""
+import argparse
+import gzip
+import heapq
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from .config import logger
+from .user_directory import (
+    USER_FIELDS,
+    EncodedUsers,
+    User,
+    UserDirectory,
+    encode_json,
+)
+from .user_provider import UserDirectoryProvider
+from .user_ingest import ingest_user_export
+from .user_search import fuzzy_keys, query_trigrams, rank_fuzzy_matches, search_terms, user_keys
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS users (
+    principal_key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    email_short TEXT NOT NULL,
+    fuzzy_keys TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+    name, email_short, email, content='users', content_rowid='rowid'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fuzzy USING fts5(
+    fuzzy_keys, content='users', content_rowid='rowid', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS users_ai AFTER INSERT ON users BEGIN
+    INSERT INTO users_fts (rowid, name, email_short, email)
+        VALUES (new.rowid, new.name, new.email_short, new.email);
+    INSERT INTO users_fuzzy (rowid, fuzzy_keys) VALUES (new.rowid, new.fuzzy_keys);
+END;
+CREATE TRIGGER IF NOT EXISTS users_ad AFTER DELETE ON users BEGIN
+    INSERT INTO users_fts (users_fts, rowid, name, email_short, email)
+        VALUES ('delete', old.rowid, old.name, old.email_short, old.email);
+    INSERT INTO users_fuzzy (users_fuzzy, rowid, fuzzy_keys)
+        VALUES ('delete', old.rowid, old.fuzzy_keys);
+END;
+CREATE TRIGGER IF NOT EXISTS users_au AFTER UPDATE ON users BEGIN
+    INSERT INTO users_fts (users_fts, rowid, name, email_short, email)
+        VALUES ('delete', old.rowid, old.name, old.email_short, old.email);
+    INSERT INTO users_fuzzy (users_fuzzy, rowid, fuzzy_keys)
+        VALUES ('delete', old.rowid, old.fuzzy_keys);
+    INSERT INTO users_fts (rowid, name, email_short, email)
+        VALUES (new.rowid, new.name, new.email_short, new.email);
+    INSERT INTO users_fuzzy (rowid, fuzzy_keys) VALUES (new.rowid, new.fuzzy_keys);
+END;
+"""
+
+_user_columns = "name, email, email_short"
+_lookup_chunk_size = 500
+_iterate_batch_size = 1000
+
+
+def _fts_phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _user(row) -> User:
+    return User(name=row[0], email=row[1], email_short=row[2])
+
+
+class SqliteUserStore:
+    """Users directory stored in SQLite, with the same read interface as UserDirectory."""
+
+    def __init__(
+        self, path: str, pool_size: int = 4, max_candidates: int = 100, pool_timeout: float = 30
+    ):
+        self.path = path
+        self._pool_timeout = pool_timeout
+        self._max_candidates = max_candidates
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self._pool.put(None)
+        self._write_lock = threading.Lock()
+        self._encoded: Dict[Tuple[str, Tuple[str, ...]], EncodedUsers] = {}
+        with self.connection() as connection:
+            connection.executescript(_schema)
+        self.mapped = False
+        self.version = self._read_version()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a connection from the pool, waiting up to `pool_timeout` seconds for one."""
+        try:
+            connection = self._pool.get(timeout=self._pool_timeout)
+        except queue.Empty:
+            raise TimeoutError(
+                f"No connection to {self.path} available within {self._pool_timeout} seconds"
+            ) from None
+        try:
+            if connection is None:
+                connection = self._connect()
+            yield connection
+        finally:
+            self._pool.put(connection)
+
+    def _read_version(self) -> str:
+        with self.connection() as connection:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else ""
+
+    def import_directory(self, directory: UserDirectory) -> Dict[str, int]:
+        """Write the users of a directory to the store, only touching rows that changed.
+
+        Returns the number of inserted, updated and deleted users.
+        """
+        with self._write_lock:
+            if directory.version and directory.version == self.version:
+                return {"inserted": 0, "updated": 0, "deleted": 0}
+
+            incoming = {}
+            count = 0
+            for user in directory:
+                incoming[user.email_short.lower()] = (
+                    user.name,
+                    user.email,
+                    user.email_short,
+                    " ".join(fuzzy_keys(user)),
+                )
+                count += 1
+            if count > len(incoming):
+                # Loaded exports are already without duplicates, see user_directory.unique_users
+                logger.warning(f"Dropped {count - len(incoming)} users with duplicate principals")
+
+            with self.connection() as connection:
+                existing = {
+                    row[0]: tuple(row[1:])
+                    for row in connection.execute(
+                        "SELECT principal_key, name, email, email_short, fuzzy_keys FROM users"
+                    )
+                }
+                deleted = [(key,) for key in existing.keys() - incoming.keys()]
+                inserted = [
+                    (key, *values) for key, values in incoming.items() if key not in existing
+                ]
+                updated = [
+                    (*values, key)
+                    for key, values in incoming.items()
+                    if key in existing and existing[key] != values
+                ]
+
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    connection.executemany("DELETE FROM users WHERE principal_key = ?", deleted)
+                    connection.executemany(
+                        "INSERT INTO users (principal_key, name, email, email_short, fuzzy_keys) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        inserted,
+                    )
+                    connection.executemany(
+                        "UPDATE users SET name = ?, email = ?, email_short = ?, fuzzy_keys = ? "
+                        "WHERE principal_key = ?",
+                        updated,
+                    )
+                    connection.execute(
+                        "INSERT INTO meta (key, value) VALUES ('version', ?) "
+                        "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                        (directory.version,),
+                    )
+                    connection.execute("COMMIT")
+                except BaseException:
+                    connection.execute("ROLLBACK")
+                    raise
+
+            self.version = directory.version
+            self._encoded = {}
+            changes = {"inserted": len(inserted), "updated": len(updated), "deleted": len(deleted)}
+            logger.info(f"Imported users to {self.path} (version {self.version}): {changes}")
+            return changes
+
+    def import_export(self, path: str) -> Dict[str, int]:
+        """Parse and filter a users export (CSV) and import it."""
+        return self.import_directory(ingest_user_export(path))
+
+    def __len__(self):
+        with self.connection() as connection:
+            return connection.execute("SELECT count(*) FROM users").fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.users)
+
+    @property
+    def users(self) -> Iterator[User]:
+        """All users ordered by principal, like in UserDirectory, read incrementally.
+
+        The users are read in batches, so an import while iterating may be partly visible.
+        """
+        after = ""
+        while True:
+            # Each batch borrows a connection only while it is read, so slow consumers (like streamed
+            # responses) do not hold on to the pool
+            with self.connection() as connection:
+                rows = connection.execute(
+                    f"SELECT {_user_columns}, principal_key FROM users WHERE principal_key > ? "
+                    "ORDER BY principal_key LIMIT ?",
+                    (after, _iterate_batch_size),
+                ).fetchall()
+            if not rows:
+                break
+            yield from map(_user, rows)
+            after = rows[-1][3]
+
+    def as_dicts(self, fields: Iterable[str] = USER_FIELDS) -> List[dict]:
+        fields = tuple(fields)
+        return [user.as_dict(fields) for user in self.users]
+
+    def encoded(self, fields: Tuple[str, ...] = USER_FIELDS) -> EncodedUsers:
+        """The JSON encoded list of users for the given projection, encoded once per imported version."""
+        version = self.version
+        encoded = self._encoded.get((version, fields))
+        if encoded is None:
+            body = encode_json(self.as_dicts(fields))
+            encoded = EncodedUsers(
+                body=body,
+                gzip_body=gzip.compress(body, compresslevel=6, mtime=0),
+                etag=f'"{version}-{"+".join(fields)}"',
+            )
+            self._encoded[(version, fields)] = encoded
+        return encoded
+
+    def page(
+        self, after: Optional[str] = None, limit: Optional[int] = None
+    ) -> Tuple[Sequence[User], Optional[str]]:
+        """A page of users ordered by principal, starting after the principal `after`."""
+        with self.connection() as connection:
+            rows = connection.execute(
+                f"SELECT {_user_columns}, principal_key FROM users WHERE principal_key > ? "
+                "ORDER BY principal_key LIMIT ?",
+                ((after or "").lower(), -1 if limit is None else limit + 1),
+            ).fetchall()
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            return [_user(row) for row in rows], rows[-1][3]
+        return [_user(row) for row in rows], None
+
+    def lookup(self, principals: Iterable[str]) -> Tuple[List[User], List[str]]:
+        """Resolve principals (email_short) to users. Returns the found users and the unknown principals."""
+        principals = list(principals)
+        keys = list({principal.strip().lower() for principal in principals})
+        by_principal = {}
+        with self.connection() as connection:
+            for start in range(0, len(keys), _lookup_chunk_size):
+                chunk = keys[start : start + _lookup_chunk_size]
+                placeholders = ",".join("?" * len(chunk))
+                for row in connection.execute(
+                    f"SELECT {_user_columns}, principal_key FROM users "
+                    f"WHERE principal_key IN ({placeholders})",
+                    chunk,
+                ):
+                    by_principal[row[3]] = _user(row)
+
+        found, unknown = [], []
+        for principal in principals:
+            user = by_principal.get(principal.strip().lower())
+            if user is None:
+                unknown.append(principal)
+            else:
+                found.append(user)
+        return found, unknown
+
+    def search(self, query: str, limit: int = 10) -> List[User]:
+        """Typeahead search: every word in the query must be a prefix of a word in name, email_short or mail.
+
+        The FTS5 index finds the candidates, which are matched and ordered like in the in-memory
+        PrefixIndex: by the first key starting with the longest term, then by principal.
+        """
+        terms = search_terms(query)
+        if not terms or limit <= 0:
+            return []
+        match = " ".join(_fts_phrase(term) + "*" for term in terms)
+        with self.connection() as connection:
+            rows = connection.execute(
+                f"SELECT {_user_columns}, principal_key FROM users WHERE rowid IN "
+                "(SELECT rowid FROM users_fts WHERE users_fts MATCH ?)",
+                (match,),
+            ).fetchall()
+
+        terms.sort(key=len, reverse=True)
+        lookup, rest = terms[0], terms[1:]
+        ranked = []
+        for row in rows:
+            user = _user(row)
+            keys = user_keys(user)
+            first_key = min((key for key in keys if key.startswith(lookup)), default=None)
+            if first_key is not None and all(any(key.startswith(term) for key in keys) for term in rest):
+                ranked.append((first_key, row[3], user))
+        return [user for _, _, user in heapq.nsmallest(limit, ranked, key=lambda match: match[:2])]
+
+    def fuzzy_search(self, query: str, limit: int = 10) -> List[User]:
+        """Diacritic- and typo-tolerant search, ranked by similarity.
+
+        Candidates sharing the most trigrams with the query are selected with the trigram FTS5 index,
+        and ranked in the same way as the in-memory TrigramIndex.
+        """
+        query_grams = query_trigrams(query)
+        inner_grams = sorted(gram for gram in query_grams if " " not in gram)
+        if not inner_grams:
+            # Too short for trigram matching
+            return self.search(query, limit)
+        match = " OR ".join(_fts_phrase(gram) for gram in inner_grams)
+        with self.connection() as connection:
+            rows = connection.execute(
+                f"SELECT {_user_columns} FROM users WHERE rowid IN "
+                "(SELECT rowid FROM users_fuzzy WHERE users_fuzzy MATCH ? ORDER BY rank LIMIT ?)",
+                (match, self._max_candidates),
+            ).fetchall()
+        return rank_fuzzy_matches(query_grams, map(_user, rows), limit)
+
+
+class SqliteUserStoreProvider(UserDirectoryProvider):
+    """Keeps a SqliteUserStore in sync with the users export.
+
+    Changes to the export are imported incrementally, and the store is served as the directory.
+    If the export is unavailable at startup, the previously imported users are served.
+    """
+
+    def __init__(self, location: str, store: SqliteUserStore):
+        super().__init__(location)
+        self.store = store
+
+    def load(self) -> SqliteUserStore:
+        try:
+            return super().load()
+        except Exception as error:
+            if not self.store.version:
+                raise
+            logger.warning(
+                f"Could not load users from {self.location} ({error}), "
+                f"serving previously imported users (version {self.store.version})"
+            )
+            self._directory = self.store
+            return self.store
+
+    def _serve(self, directory: UserDirectory) -> SqliteUserStore:
+        self.store.import_directory(directory)
+        return self.store
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Import an SSB users export (CSV) to a SQLite users database that can be used as SSB_USERS_DB"
+    )
+    parser.add_argument("export", help="Path to the users export (CSV)")
+    parser.add_argument("database", help="Path to the SQLite database")
+    parsed = parser.parse_args(args)
+    SqliteUserStore(parsed.database, pool_size=1).import_export(parsed.export)
+
+
+if __name__ == "__main__":
+    main()
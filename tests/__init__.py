@@ -3,3 +3,13 @@ import os
 
 def resolve_filename(filename):
     return os.path.join(os.path.dirname(__file__), filename)
+
+
+class Clock:
+    """A clock for tests, which only moves when `now` is set."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
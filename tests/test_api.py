@@ -1,8 +1,20 @@
+import asyncio
+import time
+
 import toml
 from fastapi.testclient import TestClient
 
 from server.clients import JiraClient, KlassClient
-from server.api import app, get_jira_client, get_klass_client
+from server.api import (
+    app,
+    get_idempotency_cache,
+    get_jira_client,
+    get_klass_client,
+    get_org_info_service,
+)
+from server.idempotency import IdempotencyCache
+from server.org_info import OrgInfoService
+from server.resilience import CircuitOpenError
 from pathlib import Path
 from server import __version__
 
@@ -11,6 +23,23 @@ jira_client_mock = JiraClient("dummy-path")
 klass_client_mock = KlassClient("dummy-path")
 
 
+def returning(value):
+    async def mock(*args, **kwargs):
+        return value
+
+    return mock
+
+
+def wait_for_job(job_id):
+    """Poll a Jira issue creation job until it is finished."""
+    for _ in range(100):
+        job = client.get(f"/create_jira/jobs/{job_id}").json()
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
 def test_health_liveness():
     response = client.get("/health/liveness")
     assert response.status_code == 200
@@ -21,6 +50,23 @@ def test_health_liveness():
 
 
 def test_health_readiness():
+    org_info_service = OrgInfoService()
+    app.dependency_overrides[get_org_info_service] = lambda: org_info_service
+
+    response = client.get("/health/readiness")
+    assert response.status_code == 503
+    assert response.json() == {
+        "name": "dapla-start-api",
+        "status": "DOWN"
+    }
+
+    klass_client = KlassClient("dummy-path")
+    klass_client.get_sectional_division_versions = returning({
+        "versions": [{"validFrom": "2000-01-01", "_links": {"self": {"href": "v1"}}}]
+    })
+    klass_client.get_sectional_division_codes = returning({"codes": []})
+    asyncio.run(org_info_service.refresh(klass_client))
+
     response = client.get("/health/readiness")
     assert response.status_code == 200
     assert response.json() == {
@@ -44,6 +90,7 @@ def test_versions_are_in_sync():
 def test_create_issue():
     # https://fastapi.tiangolo.com/advanced/testing-dependencies/?h=override
     app.dependency_overrides[get_jira_client] = lambda: jira_client_mock
+    app.dependency_overrides[get_idempotency_cache] = IdempotencyCache
     jira_response = {
         "id": "112",
         "key": "DS-1",
@@ -63,8 +110,187 @@ def test_create_issue():
     assert response.json() == jira_response
 
 
+def test_create_issues_bulk():
+    app.dependency_overrides[get_jira_client] = lambda: jira_client_mock
+    jira_client_mock.create_issues = lambda issues: [
+        {"status": "created", "issue": {"key": f"DS-{number}"}} for number, issue in enumerate(issues)
+    ]
+    details = {
+        "display_team_name": "My team",
+        "manager": {
+            "name": "Magnus Manager",
+            "email_short": "mma@ssb.no",
+            "email": "magnus.manager@ssb.no"
+        }
+    }
+
+    response = client.post("/create_jira/bulk", json=[details, {**details, "display_team_name": "Other team"}])
+    assert response.status_code == 200
+    assert response.json() == {
+        "results": [
+            {"status": "created", "issue": {"key": "DS-0"}},
+            {"status": "created", "issue": {"key": "DS-1"}},
+        ]
+    }
+
+    assert client.post("/create_jira/bulk", json=[details] * 1001).status_code == 422
+
+
+def test_create_issues_bulk_errors(monkeypatch):
+    app.dependency_overrides[get_jira_client] = lambda: JiraClient("dummy-path")
+    monkeypatch.delenv("JIRA_API_BASIC", raising=False)
+    details = {
+        "display_team_name": "My team",
+        "manager": {
+            "name": "Magnus Manager",
+            "email_short": "mma@ssb.no",
+            "email": "magnus.manager@ssb.no"
+        }
+    }
+
+    response = client.post("/create_jira/bulk", json=[details])
+    assert response.status_code == 500
+    assert "Missing env variable JIRA_API_BASIC" in response.json()["detail"]
+
+    response = client.post("/create_jira/bulk", json=[details], headers={"Authorization": "Bearer not-a-jwt"})
+    assert response.status_code == 500
+    assert response.json()["detail"].startswith("Error occurred")
+
+
+def test_create_issue_idempotency():
+    app.dependency_overrides[get_jira_client] = lambda: jira_client_mock
+    idempotency_cache = IdempotencyCache()
+    app.dependency_overrides[get_idempotency_cache] = lambda: idempotency_cache
+    created = []
+    jira_client_mock.create_issue = lambda arg: created.append(arg) or {"key": f"DS-{len(created)}"}
+    details = {
+        "display_team_name": "My team",
+        "manager": {
+            "name": "Magnus Manager",
+            "email_short": "mma@ssb.no",
+            "email": "magnus.manager@ssb.no"
+        }
+    }
+
+    response = client.post("/create_jira", json=details)
+    assert response.status_code == 201
+    assert response.json() == {"key": "DS-1"}
+    assert "idempotent-replayed" not in response.headers
+
+    # The same details, differently formatted
+    response = client.post("/create_jira", json={**details, "display_team_name": " my  Team "})
+    assert response.status_code == 201
+    assert response.json() == {"key": "DS-1"}
+    assert response.headers["idempotent-replayed"] == "true"
+
+    response = client.post("/create_jira", headers={"Idempotency-Key": "a"}, json=details)
+    assert response.json() == {"key": "DS-2"}
+    response = client.post("/create_jira", headers={"Idempotency-Key": "a"}, json=details)
+    assert response.json() == {"key": "DS-2"}
+    assert len(created) == 2
+
+    # The same key for another team
+    response = client.post(
+        "/create_jira", headers={"Idempotency-Key": "a"}, json={**details, "display_team_name": "Other team"}
+    )
+    assert response.status_code == 422
+    assert len(created) == 2
+
+
+def test_create_issue_respond_async_retries_failed_job():
+    app.dependency_overrides[get_jira_client] = lambda: jira_client_mock
+    idempotency_cache = IdempotencyCache()
+    app.dependency_overrides[get_idempotency_cache] = lambda: idempotency_cache
+    attempts = []
+
+    def create_issue(issue):
+        attempts.append(issue)
+        if len(attempts) == 1:
+            raise ConnectionError("Jira is down")
+        return {"key": "DS-1"}
+
+    jira_client_mock.create_issue = create_issue
+    details = {
+        "display_team_name": "My team",
+        "manager": {
+            "name": "Magnus Manager",
+            "email_short": "mma@ssb.no",
+            "email": "magnus.manager@ssb.no"
+        }
+    }
+
+    first = client.post("/create_jira", headers={"Prefer": "respond-async"}, json=details).json()
+    assert wait_for_job(first["id"])["status"] == "failed"
+
+    response = client.post("/create_jira", headers={"Prefer": "respond-async"}, json=details)
+    assert response.status_code == 202
+    assert "idempotent-replayed" not in response.headers
+    retry = response.json()
+    assert retry["id"] != first["id"]
+    assert wait_for_job(retry["id"])["issue_key"] == "DS-1"
+
+    # Once done, the job is replayed with its current state
+    response = client.post("/create_jira", headers={"Prefer": "respond-async"}, json=details)
+    assert response.headers["idempotent-replayed"] == "true"
+    assert response.json()["id"] == retry["id"]
+    assert response.json()["status"] == "done"
+    assert len(attempts) == 2
+
+
+def test_create_issue_circuit_open():
+    app.dependency_overrides[get_jira_client] = lambda: jira_client_mock
+    app.dependency_overrides[get_idempotency_cache] = IdempotencyCache
+
+    def create_issue(issue):
+        raise CircuitOpenError(retry_after=12.3)
+
+    jira_client_mock.create_issue = create_issue
+
+    response = client.post("/create_jira", json={
+        "display_team_name": "My team",
+        "manager": {
+            "name": "Magnus Manager",
+            "email_short": "mma@ssb.no",
+            "email": "magnus.manager@ssb.no"
+        }
+    })
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "12"
+
+
+def test_create_issue_respond_async():
+    app.dependency_overrides[get_jira_client] = lambda: jira_client_mock
+    app.dependency_overrides[get_idempotency_cache] = IdempotencyCache
+    jira_response = {
+        "id": "112",
+        "key": "DS-1",
+        "self": "https://statistics-norway.atlassian.net/rest/api/3/issue/112"
+    }
+    jira_client_mock.create_issue = lambda arg: jira_response
+
+    response = client.post("/create_jira", headers={"Prefer": "respond-async"}, json={
+        "display_team_name": "My team",
+        "manager": {
+            "name": "Magnus Manager",
+            "email_short": "mma@ssb.no",
+            "email": "magnus.manager@ssb.no"
+        }
+    })
+    assert response.status_code == 202
+    assert response.headers["preference-applied"] == "respond-async"
+    job_id = response.json()["id"]
+    assert response.headers["location"] == f"/create_jira/jobs/{job_id}"
+
+    job = wait_for_job(job_id)
+    assert job["issue_key"] == "DS-1"
+    assert job["result"] == jira_response
+
+    assert client.get("/create_jira/jobs/unknown").status_code == 404
+
+
 def test_org_info():
     app.dependency_overrides[get_klass_client] = lambda: klass_client_mock
+    app.dependency_overrides[get_org_info_service] = OrgInfoService
 
     klass_versions_response = {
         "versions": [
@@ -108,8 +334,13 @@ def test_org_info():
         ]
     }
 
-    klass_client_mock.get_sectional_division_versions = lambda: klass_versions_response
-    klass_client_mock.get_latest_sectional_division_version = lambda arg: klass_latest_version_response
+    klass_client_mock.get_sectional_division_versions = returning(klass_versions_response)
+
+    async def get_sectional_division_codes(day, level=None):
+        items = klass_latest_version_response["classificationItems"]
+        return {"codes": [item for item in items if level is None or item["level"] == str(level)]}
+
+    klass_client_mock.get_sectional_division_codes = get_sectional_division_codes
 
     client_response = [
         {
@@ -128,3 +359,164 @@ def test_org_info():
 
     assert response.status_code == 200
     assert response.json() == client_response
+    assert response.headers["x-data-stale"] == "false"
+
+    response = client.get("/org_info/tree")
+    assert response.status_code == 200
+    assert [section["code"] for section in response.json()[0]["children"]] == ["11", "12"]
+
+    response = client.get("/org_info/12")
+    assert response.status_code == 200
+    assert response.json() == {"code": "12", "parent_code": "1", "name": "Seksjon 12", "level": "2"}
+
+    response = client.get("/org_info/1/children")
+    assert response.status_code == 200
+    assert [section["code"] for section in response.json()] == ["11", "12"]
+
+    assert client.get("/org_info/99").status_code == 404
+    assert client.get("/org_info/99/children").status_code == 404
+
+    response = client.get("/org_info", params={"date": "2005-06-01"})
+    assert response.status_code == 200
+    assert response.json() == client_response
+
+    assert client.get("/org_info", params={"date": "1990-01-01"}).status_code == 404
+    assert client.get("/org_info", params={"date": "not-a-date"}).status_code == 422
+
+
+def test_org_info_invalid_klass_response():
+    app.dependency_overrides[get_org_info_service] = OrgInfoService
+
+    for versions in ({}, {"versions": []}):
+        klass_client = KlassClient("dummy-path")
+        klass_client.get_sectional_division_versions = returning(versions)
+        app.dependency_overrides[get_klass_client] = lambda: klass_client
+
+        response = client.get("/org_info", params={"date": "2005-06-01"})
+        assert response.status_code == 500
+
+
+def test_list_users():
+    response = client.get("/users")
+
+    assert response.status_code == 200
+    assert response.json()[0] == {
+        "name": "Åberg, Albert",
+        "email": "albert.aaberg@ssb.no",
+        "email_short": "abc@ssb.no"
+    }
+    assert len(response.json()) == 4
+
+
+def test_list_users_fields():
+    response = client.get("/users", params={"fields": "email_short,name"})
+
+    assert response.status_code == 200
+    assert response.json()[1] == {
+        "name": "Duck, Donald",
+        "email_short": "don@ssb.no"
+    }
+
+
+def test_list_users_etag():
+    response = client.get("/users", params={"fields": "name"})
+    etag = response.headers["etag"]
+
+    assert response.status_code == 200
+    assert response.json()[0] == {"name": "Åberg, Albert"}
+
+    not_modified = client.get("/users", params={"fields": "name"}, headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+
+    other_projection = client.get("/users", params={"fields": "email"}, headers={"If-None-Match": etag})
+    assert other_projection.status_code == 200
+
+
+def test_list_users_gzip():
+    response = client.get("/users", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert len(response.json()) == 4
+
+    identity = client.get("/users", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in identity.headers
+    assert identity.headers["etag"] != response.headers["etag"]
+    assert response.headers["etag"] == identity.headers["etag"][:-1] + '-gz"'
+
+    for etag in (response.headers["etag"], identity.headers["etag"]):
+        not_modified = client.get("/users", headers={"Accept-Encoding": "identity", "If-None-Match": etag})
+        assert not_modified.status_code == 304
+        assert not_modified.headers["etag"] == identity.headers["etag"]
+
+
+def test_search_users():
+    response = client.get("/users/search", params={"q": "duck", "fields": "email_short"})
+
+    assert response.status_code == 200
+    assert response.json() == [{"email_short": "don@ssb.no"}]
+
+
+def test_search_users_fuzzy():
+    response = client.get("/users/search", params={"q": "aberg", "mode": "fuzzy", "fields": "name"})
+
+    assert response.status_code == 200
+    assert response.json() == [{"name": "Åberg, Albert"}]
+
+
+def test_lookup_users():
+    response = client.post(
+        "/users/lookup",
+        params={"fields": "name,email_short"},
+        json={"principals": ["MIM@ssb.no", "xxx@ssb.no", "abc@ssb.no"]}
+    )
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "users": [
+            {"name": "Mus, Mikke", "email_short": "mim@ssb.no"},
+            {"name": "Åberg, Albert", "email_short": "abc@ssb.no"}
+        ],
+        "unknown": ["xxx@ssb.no"]
+    }
+
+
+def test_list_users_paginated():
+    first = client.get("/users", params={"limit": 3, "fields": "email_short"})
+
+    assert first.status_code == 200
+    assert first.json() == [
+        {"email_short": "abc@ssb.no"},
+        {"email_short": "don@ssb.no"},
+        {"email_short": "lab@ssb.no"}
+    ]
+    cursor = first.headers["x-next-cursor"]
+    assert 'rel="next"' in first.headers["link"]
+
+    second = client.get("/users", params={"limit": 3, "fields": "email_short", "cursor": cursor})
+    assert second.json() == [{"email_short": "mim@ssb.no"}]
+    assert "x-next-cursor" not in second.headers
+
+
+def test_pagination_headers_are_exposed_to_the_ui():
+    response = client.get(
+        "/users", params={"limit": 1}, headers={"Origin": "https://start.dapla.ssb.no"}
+    )
+
+    exposed = response.headers["access-control-expose-headers"].lower()
+    assert "x-next-cursor" in exposed
+    assert "link" in exposed
+
+
+def test_list_users_invalid_cursor():
+    response = client.get("/users", params={"cursor": "%%%"})
+    assert response.status_code == 400
+
+
+def test_list_users_ndjson():
+    response = client.get("/users", params={"fields": "email_short"}, headers={"Accept": "application/x-ndjson"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.text.splitlines()[0] == '{"email_short":"abc@ssb.no"}'
+    assert len(response.text.splitlines()) == 4
@@ -0,0 +1,185 @@
+import asyncio
+
+import httpx
+import pytest
+
+from tests import Clock
+from server.cache import DiskResponseCache, StaleResponse, TTLCache
+from server.clients import CachingKlassClient, KlassClient
+
+
+@pytest.fixture()
+def clock():
+    return Clock()
+
+
+def loader_of(value, calls=None):
+    async def loader():
+        if calls is not None:
+            calls.append(value)
+        return value
+
+    return loader
+
+
+def test_serves_fresh_entries_from_cache(clock):
+    cache = TTLCache(ttl=10, clock=clock)
+    calls = []
+
+    async def run():
+        assert await cache.get("key", loader_of("first", calls)) == "first"
+        clock.now = 9
+        assert await cache.get("key", loader_of("second", calls)) == "first"
+
+    asyncio.run(run())
+    assert calls == ["first"]
+
+
+def test_reloads_expired_entries(clock):
+    cache = TTLCache(ttl=10, stale_while_revalidate=5, clock=clock)
+
+    async def run():
+        await cache.get("key", loader_of("first"))
+        clock.now = 15
+        assert await cache.get("key", loader_of("second")) == "second"
+
+    asyncio.run(run())
+
+
+def test_serves_stale_entries_while_revalidating(clock):
+    cache = TTLCache(ttl=10, stale_while_revalidate=5, clock=clock)
+    calls = []
+
+    async def run():
+        await cache.get("key", loader_of("first"))
+        clock.now = 12
+        assert await cache.get("key", loader_of("second", calls)) == "first"
+        # A refresh is already running for the key
+        assert await cache.get("key", loader_of("second", calls)) == "first"
+        for _ in range(100):
+            if await cache.get("key", loader_of("second", calls)) == "second":
+                break
+            await asyncio.sleep(0.01)
+        assert await cache.get("key", loader_of("second", calls)) == "second"
+
+    asyncio.run(run())
+    assert calls == ["second"]
+
+
+def test_keeps_stale_entry_when_refresh_fails(clock):
+    cache = TTLCache(ttl=10, stale_while_revalidate=5, clock=clock)
+
+    async def run():
+        failed = asyncio.Event()
+
+        async def loader():
+            failed.set()
+            raise ConnectionError("Klass is down")
+
+        await cache.get("key", loader_of("first"))
+        clock.now = 12
+        assert await cache.get("key", loader) == "first"
+        await asyncio.wait_for(failed.wait(), 1)
+        await asyncio.sleep(0)
+        assert await cache.get("key", loader) == "first"
+
+    asyncio.run(run())
+
+
+def test_caching_klass_client():
+    klass_client = KlassClient("dummy-path")
+    calls = []
+    klass_client.get_sectional_division_versions = loader_of({"versions": []}, calls)
+
+    async def get_version(url):
+        return {"url": url}
+
+    klass_client.get_latest_sectional_division_version = get_version
+    caching_client = CachingKlassClient(klass_client, ttl=60)
+
+    async def run():
+        assert await caching_client.get_sectional_division_versions() == {"versions": []}
+        assert await caching_client.get_sectional_division_versions() == {"versions": []}
+        assert await caching_client.get_latest_sectional_division_version("a") == {"url": "a"}
+        assert await caching_client.get_latest_sectional_division_version("b") == {"url": "b"}
+
+    asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_klass_client_revalidates_and_falls_back_to_disk_cache(tmp_path):
+    sent_headers = []
+    responses = [
+        httpx.Response(200, json={"versions": ["v1"]}, headers={"ETag": '"e1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}),
+        httpx.Response(304),
+        httpx.ConnectError("data.ssb.no is down"),
+        httpx.Response(503),
+    ]
+
+    def handler(request):
+        sent_headers.append(request.headers)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def klass_client(cache):
+        return KlassClient(
+            "https://klass",
+            response_cache=cache,
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        )
+
+    cache = DiskResponseCache(str(tmp_path))
+    restarted_cache = DiskResponseCache(str(tmp_path))
+
+    async def run():
+        client = klass_client(cache)
+        assert await client.get_sectional_division_versions() == {"versions": ["v1"]}
+        assert "If-None-Match" not in sent_headers[-1]
+
+        assert await client.get_sectional_division_versions() == {"versions": ["v1"]}
+        assert sent_headers[-1]["If-None-Match"] == '"e1"'
+        assert sent_headers[-1]["If-Modified-Since"] == "Mon, 01 Jan 2024 00:00:00 GMT"
+
+        # After a restart, the last known good response is read from disk
+        restarted_client = klass_client(restarted_cache)
+        for _ in range(2):
+            with pytest.raises(StaleResponse) as stale:
+                await restarted_client.get_sectional_division_versions()
+            assert stale.value.value == {"versions": ["v1"]}
+
+    asyncio.run(run())
+    assert restarted_cache.age() is not None
+
+
+def test_stale_responses_are_not_cached(clock):
+    cache = TTLCache(ttl=10, clock=clock)
+    responses = [StaleResponse("last known good", ValueError("down")), "fresh"]
+
+    async def load():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def run():
+        with pytest.raises(StaleResponse):
+            await cache.get("key", load)
+        return await cache.get("key", load)
+
+    assert asyncio.run(run()) == "fresh"
+
+
+def test_klass_client_without_cached_response_raises(tmp_path):
+    def handler(request):
+        raise httpx.ConnectError("data.ssb.no is down")
+
+    client = KlassClient(
+        "https://klass",
+        response_cache=DiskResponseCache(str(tmp_path)),
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(client.get_sectional_division_versions())
@@ -0,0 +1,255 @@
+import asyncio
+import gzip
+import json
+from datetime import date
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+import requests
+from prometheus_client import REGISTRY
+
+from server.clients import AsyncSingleFlight, JiraClient, KlassClient, SingleFlight
+from server.resilience import RetryPolicy
+from server.org_info import OrgInfoService
+
+
+def test_single_flight_shares_result_and_errors():
+    single_flight = SingleFlight()
+    assert single_flight.do("key", lambda: 1) == 1
+
+    def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        single_flight.do("key", fail)
+
+    # A failed call is not cached
+    assert single_flight.do("key", lambda: 2) == 2
+
+
+def test_async_single_flight_shares_result_and_errors():
+    single_flight = AsyncSingleFlight()
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def fail():
+        raise ValueError("failed")
+
+    async def run():
+        assert await asyncio.gather(*(single_flight.do("key", call) for _ in range(10))) == [1] * 10
+        with pytest.raises(ValueError):
+            await single_flight.do("key", fail)
+        assert await single_flight.do("key", call) == 2
+
+    asyncio.run(run())
+
+
+class SlowKlass:
+    def __init__(self):
+        self.calls = []
+
+    async def handle(self, request):
+        url = str(request.url)
+        self.calls.append(url)
+        await asyncio.sleep(0.2)
+        if url.endswith("/classifications/83"):
+            return httpx.Response(
+                200,
+                json={"versions": [{"validFrom": "2000-01-01", "_links": {"self": {"href": "https://klass/versions/1"}}}]},
+            )
+        return httpx.Response(
+            200,
+            json={"codes": [{"code": "11", "parentCode": "1", "name": "Seksjon 11", "level": "2"}]},
+        )
+
+    def client(self):
+        return KlassClient(
+            "https://klass",
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(self.handle)),
+        )
+
+
+def test_concurrent_requests_make_one_upstream_call():
+    klass = SlowKlass()
+    klass_client = klass.client()
+
+    async def run():
+        return await asyncio.gather(*(klass_client.get_sectional_division_versions() for _ in range(100)))
+
+    results = asyncio.run(run())
+    assert klass.calls == ["https://klass/classifications/83"]
+    assert all(result == results[0] for result in results)
+
+
+def test_concurrent_cold_org_info_requests_share_upstream_calls():
+    klass = SlowKlass()
+    klass_client = klass.client()
+    service = OrgInfoService()
+
+    async def run():
+        return await asyncio.gather(*(service.get(klass_client) for _ in range(100)))
+
+    results = asyncio.run(run())
+    assert sorted(klass.calls) == [
+        "https://klass/classifications/83",
+        "https://klass/classifications/83/codesAt?date=2000-01-01&selectLevel=2",
+    ]
+    assert results[0] == [{"code": "11", "parent_code": "1", "name": "Seksjon 11"}]
+
+
+def test_klass_client_requests_gzip_compressed_codes():
+    requests = []
+
+    def handle(request):
+        requests.append(request)
+        body = gzip.compress(json.dumps({"codes": []}).encode("utf-8"))
+        return httpx.Response(200, content=body, headers={"Content-Encoding": "gzip"})
+
+    klass_client = KlassClient(
+        "https://klass/",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handle)),
+    )
+
+    assert asyncio.run(klass_client.get_sectional_division_codes(date(2024, 1, 1), level=2)) == {"codes": []}
+    assert str(requests[0].url) == "https://klass/classifications/83/codesAt?date=2024-01-01&selectLevel=2"
+    assert requests[0].headers["Accept-Encoding"] == "gzip"
+
+
+class JiraServer:
+    """Local stand-in for Jira, keeping connections alive between requests."""
+
+    def __init__(self):
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests.append(("GET", self.path))
+                self._respond({"version": "1001.0.0"})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                server.requests.append(("POST", self.path))
+                self._respond({"key": f"DS-{len(server.requests)}"})
+
+            def _respond(self, body):
+                content = json.dumps(body).encode("utf-8")
+                self.send_response(201 if self.command == "POST" else 200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}/rest/api/3"
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture()
+def jira_server():
+    server = JiraServer()
+    yield server
+    server.close()
+
+
+def counter_value(name):
+    return REGISTRY.get_sample_value(name) or 0
+
+
+def test_jira_client_reuses_warmed_up_connection(jira_server, monkeypatch):
+    monkeypatch.setenv("JIRA_API_BASIC", "dXNlcjp0b2tlbg==")
+    jira_client = JiraClient(jira_server.url, pool_size=2)
+    opened = counter_value("dapla_start_jira_connections_opened_total")
+    sent = counter_value("dapla_start_jira_requests_total")
+
+    jira_client.warm_up()
+    for _ in range(3):
+        jira_client.create_issue({"fields": {}})
+    jira_client.close()
+
+    assert jira_server.requests == [("GET", "/rest/api/3/serverInfo")] + [("POST", "/rest/api/3/issue")] * 3
+    assert counter_value("dapla_start_jira_requests_total") - sent == 4
+    assert counter_value("dapla_start_jira_connections_opened_total") - opened == 1
+
+
+def test_jira_client_warm_up_ignores_errors():
+    JiraClient("http://127.0.0.1:1/rest/api/3", connect_timeout=1).warm_up()
+
+
+def jira_response(status_code, body):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body).encode("utf-8")
+    return response
+
+
+def test_jira_client_creates_issues_in_batches(monkeypatch):
+    monkeypatch.setenv("JIRA_API_BASIC", "dXNlcjp0b2tlbg==")
+    jira_client = JiraClient("https://jira/rest/api/3")
+    batches = []
+
+    def post(url, headers, json, timeout):
+        assert url == "https://jira/rest/api/3/issue/bulk"
+        batch = [issue["fields"]["summary"] for issue in json["issueUpdates"]]
+        batches.append(batch)
+        if len(batches) == 1:
+            return jira_response(201, {"issues": [{"key": f"DS-{summary}"} for summary in batch], "errors": []})
+        if len(batches) == 2:
+            # The second and fourth issues are rejected
+            return jira_response(201, {
+                "issues": [{"key": f"DS-{summary}"} for position, summary in enumerate(batch) if position not in (1, 3)],
+                "errors": [
+                    {"status": 400, "elementErrors": {"errors": {"summary": "too long"}}, "failedElementNumber": 1},
+                    {"status": 400, "elementErrors": {"errors": {"summary": "too long"}}, "failedElementNumber": 3},
+                ],
+            })
+        return jira_response(400, {
+            "issues": [],
+            "errors": [
+                {"status": 400, "elementErrors": {"errors": {"project": "invalid"}}, "failedElementNumber": position}
+                for position in range(len(batch))
+            ],
+        })
+
+    monkeypatch.setattr(jira_client._session, "post", post)
+
+    results = jira_client.create_issues([{"fields": {"summary": str(number)}} for number in range(120)])
+
+    assert [len(batch) for batch in batches] == [50, 50, 20]
+    assert len(results) == 120
+    assert results[0] == {"status": "created", "issue": {"key": "DS-0"}}
+    assert results[50] == {"status": "created", "issue": {"key": "DS-50"}}
+    assert results[51] == {"status": "failed", "error": {"errors": {"summary": "too long"}}}
+    assert results[52] == {"status": "created", "issue": {"key": "DS-52"}}
+    assert results[53]["status"] == "failed"
+    assert results[54] == {"status": "created", "issue": {"key": "DS-54"}}
+    assert results[119] == {"status": "failed", "error": {"errors": {"project": "invalid"}}}
+    assert sum(result["status"] == "created" for result in results) == 98
+
+
+def test_jira_client_bulk_batch_failure(monkeypatch):
+    monkeypatch.setenv("JIRA_API_BASIC", "dXNlcjp0b2tlbg==")
+    jira_client = JiraClient("https://jira/rest/api/3", retry=RetryPolicy(attempts=1))
+    monkeypatch.setattr(
+        jira_client._session, "post", lambda url, headers, json, timeout: jira_response(401, {"message": "Unauthorized"})
+    )
+
+    assert jira_client.create_issues([{"fields": {}}] * 2) == [
+        {"status": "failed", "error": '{"message": "Unauthorized"}'},
+    ] * 2
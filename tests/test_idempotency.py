@@ -0,0 +1,103 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from tests import Clock
+from server.idempotency import IdempotencyCache, IdempotencyKeyReused, fingerprint
+from server.project_details import ProjectDetails
+
+
+def details(**kwargs):
+    return ProjectDetails(
+        **{
+            "display_team_name": "My team",
+            "manager": {"name": "Magnus Manager", "email_short": "mma@ssb.no", "email": "magnus.manager@ssb.no"},
+            **kwargs,
+        }
+    )
+
+
+def test_fingerprint_ignores_formatting():
+    developers = [
+        {"name": "Donald Duck", "email_short": "don@ssb.no", "email": "donald.duck@ssb.no"},
+        {"name": "Albert Åberg", "email_short": "abc@ssb.no", "email": "albert.aaberg@ssb.no"},
+    ]
+    assert fingerprint(details(developers=developers)) == fingerprint(
+        details(display_team_name=" my  TEAM", developers=developers[::-1], api_version="1.2.3")
+    )
+    assert fingerprint(details()) != fingerprint(details(display_team_name="Other team"))
+
+
+def test_replays_result_within_window():
+    clock = Clock()
+    cache = IdempotencyCache(window=60, clock=clock)
+    calls = []
+
+    assert cache.run("key", lambda: calls.append(1) or "first") == ("first", False)
+    clock.now = 59
+    assert cache.run("key", lambda: calls.append(1) or "second") == ("first", True)
+    assert cache.run("other", lambda: "other") == ("other", False)
+
+    clock.now = 61
+    assert cache.run("key", lambda: calls.append(1) or "third") == ("third", False)
+    assert len(calls) == 2
+
+
+def test_failures_are_not_remembered():
+    cache = IdempotencyCache()
+
+    def fail():
+        raise ConnectionError("Jira is down")
+
+    with pytest.raises(ConnectionError):
+        cache.run("key", fail)
+    assert cache.run("key", lambda: "created") == ("created", False)
+
+
+def test_concurrent_duplicates_wait_for_the_first():
+    cache = IdempotencyCache()
+    calls = []
+    started = threading.Event()
+
+    def create():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return "DS-1"
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        first = executor.submit(cache.run, "key", create)
+        started.wait(1)
+        duplicates = [executor.submit(cache.run, "key", create) for _ in range(9)]
+        assert first.result() == ("DS-1", False)
+        assert [duplicate.result() for duplicate in duplicates] == [("DS-1", True)] * 9
+    assert len(calls) == 1
+
+
+def test_reused_key_with_different_content_is_rejected():
+    cache = IdempotencyCache()
+
+    assert cache.run("key", lambda: "DS-1", fingerprint="a") == ("DS-1", False)
+    assert cache.run("key", lambda: "DS-2", fingerprint="a") == ("DS-1", True)
+    with pytest.raises(IdempotencyKeyReused):
+        cache.run("key", lambda: "DS-2", fingerprint="b")
+
+
+def test_concurrent_call_with_reused_key_is_rejected():
+    cache = IdempotencyCache()
+    started = threading.Event()
+
+    def create():
+        started.set()
+        time.sleep(0.2)
+        return "DS-1"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(cache.run, "key", create, "a")
+        started.wait(1)
+        other = executor.submit(cache.run, "key", lambda: "DS-2", "b")
+        assert first.result() == ("DS-1", False)
+        with pytest.raises(IdempotencyKeyReused):
+            other.result()
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from tests import Clock
+from server.clients import JiraClient
+from server.jira_jobs import DONE, FAILED, QUEUED, JiraJobQueue
+
+
+def wait_for(job, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        if job.status in (DONE, FAILED):
+            return job
+        time.sleep(0.01)
+    pytest.fail(f"Job {job.id} did not finish")
+
+
+def test_creates_issue_in_background():
+    jobs = JiraJobQueue(workers=1)
+    release = threading.Event()
+    jira_client = JiraClient("dummy-path")
+    jira_client.create_issue = lambda issue: release.wait(5) and {"id": "112", "key": "DS-1"}
+
+    job = jobs.submit(jira_client, {"fields": {}})
+    assert jobs.get(job.id).as_dict()["status"] in (QUEUED, "running")
+
+    release.set()
+    assert wait_for(job).as_dict() == {
+        "id": job.id,
+        "status": DONE,
+        "issue_key": "DS-1",
+        "result": {"id": "112", "key": "DS-1"},
+        "error": None,
+    }
+    jobs.shutdown()
+
+
+def test_reports_jira_errors():
+    jobs = JiraJobQueue(workers=1)
+    jira_client = JiraClient("dummy-path")
+    response = requests.Response()
+    response._content = b'{"errors": {"summary": "required"}}'
+
+    def create_issue(issue):
+        raise requests.HTTPError("400 Client Error", response=response)
+
+    jira_client.create_issue = create_issue
+
+    job = wait_for(jobs.submit(jira_client, {"fields": {}}))
+    assert job.status == FAILED
+    assert job.error == '{"errors": {"summary": "required"}}'
+    assert job.as_dict()["issue_key"] is None
+    jobs.shutdown()
+
+
+def test_forgets_finished_jobs_after_retention():
+    clock = Clock()
+    jobs = JiraJobQueue(workers=1, retention=60, clock=clock)
+    jira_client = JiraClient("dummy-path")
+    jira_client.create_issue = lambda issue: {"key": "DS-1"}
+
+    job = wait_for(jobs.submit(jira_client, {}))
+    clock.now = 59
+    jobs.submit(jira_client, {})
+    assert jobs.get(job.id) is job
+
+    clock.now = 61
+    wait_for(jobs.submit(jira_client, {}))
+    assert jobs.get(job.id) is None
+    jobs.shutdown()
@@ -0,0 +1,209 @@
+import asyncio
+from datetime import date
+
+import pytest
+
+from server.cache import StaleResponse
+from server.clients import KlassClient
+from server.org_info import (
+    NoVersionError,
+    OrgIndex,
+    OrgInfoService,
+    VersionIndex,
+    get_klass_sectional_division,
+    produce_org_info,
+    produce_org_info_from_codes,
+)
+
+versions = {
+    "versions": [
+        {"validFrom": "2000-01-01", "_links": {"self": {"href": "https://klass/versions/1"}}},
+        {"validFrom": "2010-01-01", "_links": {"self": {"href": "https://klass/versions/2"}}},
+    ]
+}
+version_2 = {
+    "classificationItems": [
+        {"code": "1", "name": "Avdeling 1", "level": "1"},
+        {"code": "11", "parentCode": "1", "name": "Seksjon 11", "level": "2"},
+    ]
+}
+
+
+def klass_client(calls=None):
+    client = KlassClient("dummy-path")
+
+    async def get_sectional_division_versions():
+        return versions
+
+    async def get_sectional_division_codes(day, level=None):
+        if calls is not None:
+            calls.append((day.isoformat(), level))
+        return {
+            "codes": [
+                item for item in version_2["classificationItems"] if level is None or item["level"] == str(level)
+            ]
+        }
+
+    client.get_sectional_division_versions = get_sectional_division_versions
+    client.get_sectional_division_codes = get_sectional_division_codes
+    return client
+
+
+def test_org_info_service_serves_from_memory():
+    calls = []
+    service = OrgInfoService()
+    assert not service.ready
+
+    assert asyncio.run(service.get(klass_client(calls))) == [{"code": "11", "parent_code": "1", "name": "Seksjon 11"}]
+    assert asyncio.run(service.get(klass_client(calls))) == [{"code": "11", "parent_code": "1", "name": "Seksjon 11"}]
+    assert service.ready
+    assert calls == [("2010-01-01", 2)]
+
+
+def test_org_info_service_keeps_refreshed():
+    calls = []
+    service = OrgInfoService()
+
+    async def run():
+        task = asyncio.create_task(service.keep_refreshed(klass_client(calls), interval=0.01))
+        while len(calls) < 3:
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert service.ready
+
+
+def test_org_index():
+    index = OrgIndex(
+        version_2["classificationItems"]
+        + [
+            {"code": "12", "parentCode": "1", "name": "Seksjon 12", "level": "2"},
+            {"code": "2", "parentCode": None, "name": "Avdeling 2", "level": "1"},
+        ]
+    )
+
+    assert index.get("11") == {"code": "11", "parent_code": "1", "name": "Seksjon 11", "level": "2"}
+    assert index.get("99") is None
+    assert [item["code"] for item in index.children_of("1")] == ["11", "12"]
+    assert index.children_of("2") == []
+    assert [(item["code"], [child["code"] for child in item["children"]]) for item in index.tree] == [
+        ("1", ["11", "12"]),
+        ("2", []),
+    ]
+
+
+def test_org_info_service_index():
+    calls = []
+    service = OrgInfoService()
+
+    assert asyncio.run(service.index(klass_client(calls))).get("11")["name"] == "Seksjon 11"
+    assert asyncio.run(service.get(klass_client(calls))) == [{"code": "11", "parent_code": "1", "name": "Seksjon 11"}]
+    assert asyncio.run(service.index(klass_client(calls))).get("1")["name"] == "Avdeling 1"
+    assert calls == [("2010-01-01", 2), ("2010-01-01", None)]
+
+    # Once asked for, the index is refreshed too
+    asyncio.run(service.refresh(klass_client(calls)))
+    assert calls[2:] == [("2010-01-01", 2), ("2010-01-01", None)]
+
+
+def test_version_index():
+    index = VersionIndex(
+        [
+            {"validFrom": "2010-01-01", "_links": {"self": {"href": "v2"}}},
+            {"validFrom": "2000-01-01", "validTo": "2005-01-01", "_links": {"self": {"href": "v1"}}},
+        ]
+    )
+
+    assert index.newest_url == "v2"
+    assert index.newest_valid_from == date(2010, 1, 1)
+    assert index.url_at(date(1999, 12, 31)) is None
+    assert index.url_at(date(2000, 1, 1)) == "v1"
+    assert index.url_at(date(2004, 12, 31)) == "v1"
+    assert index.url_at(date(2005, 1, 1)) is None
+    assert index.url_at(date(2010, 1, 1)) == "v2"
+    assert index.url_at(date(2030, 1, 1)) == "v2"
+    assert get_klass_sectional_division(versions) == "https://klass/versions/2"
+
+
+def test_org_info_service_dated():
+    calls = []
+    client = klass_client(calls)
+    service = OrgInfoService()
+
+    assert asyncio.run(service.get(client, date(2005, 6, 1))) == [{"code": "11", "parent_code": "1", "name": "Seksjon 11"}]
+    assert asyncio.run(service.get(client, date(2005, 6, 1))) == [{"code": "11", "parent_code": "1", "name": "Seksjon 11"}]
+    assert asyncio.run(service.get(client, date(2015, 6, 1))) == [{"code": "11", "parent_code": "1", "name": "Seksjon 11"}]
+    # The newest version is fetched by the refresh, the older one once
+    assert calls == [("2010-01-01", 2), ("2005-06-01", 2)]
+
+    with pytest.raises(NoVersionError):
+        asyncio.run(service.get(client, date(1990, 1, 1)))
+
+
+def test_org_info_service_tracks_stale_data_per_version():
+    calls = []
+    client = klass_client(calls)
+    fresh_codes = client.get_sectional_division_codes
+    klass_down = False
+
+    async def get_sectional_division_codes(day, level=None):
+        codes = await fresh_codes(day, level)
+        if klass_down:
+            raise StaleResponse(codes, ConnectionError("Klass is down"))
+        return codes
+
+    client.get_sectional_division_codes = get_sectional_division_codes
+    service = OrgInfoService()
+    asyncio.run(service.refresh(client))
+
+    klass_down = True
+    asyncio.run(service.get(client, date(2005, 6, 1)))
+    assert service.stale(date(2005, 6, 1))
+    assert not service.stale()
+
+    # Stale data of an older version is not kept, it is fetched again once Klass is back
+    klass_down = False
+    asyncio.run(service.get(client, date(2005, 6, 1)))
+    assert not service.stale(date(2005, 6, 1))
+    assert calls == [("2010-01-01", 2), ("2005-06-01", 2), ("2005-06-01", 2)]
+
+    # The newest version is kept while stale, and the next refresh clears it
+    klass_down = True
+    asyncio.run(service.refresh(client))
+    assert service.stale()
+    assert asyncio.run(service.get(client)) == [{"code": "11", "parent_code": "1", "name": "Seksjon 11"}]
+    klass_down = False
+    asyncio.run(service.refresh(client))
+    assert not service.stale()
+
+
+def test_org_info_from_codes_matches_org_info_from_version():
+    version = {
+        "classificationItems": [
+            {"code": "100", "parentCode": None, "level": "1", "name": "Avdeling 100", "shortName": "", "notes": ""},
+            {"code": "110", "parentCode": "100", "level": "2", "name": "Seksjon 110", "shortName": "", "notes": ""},
+            {"code": "120", "parentCode": "100", "level": "2", "name": "Seksjon 120", "shortName": "", "notes": ""},
+            {"code": "200", "parentCode": None, "level": "1", "name": "Avdeling 200", "shortName": "", "notes": ""},
+            {"code": "210", "parentCode": "200", "level": "2", "name": "Seksjon 210", "shortName": "", "notes": ""},
+        ]
+    }
+    codes_at = {
+        "codes": [
+            {
+                "code": item["code"],
+                "parentCode": item["parentCode"],
+                "level": item["level"],
+                "name": item["name"],
+                "shortName": "",
+                "presentationName": "",
+                "validFrom": "2010-01-01",
+                "validTo": None,
+                "notes": "",
+            }
+            for item in version["classificationItems"]
+            if item["level"] == "2"
+        ]
+    }
+
+    assert produce_org_info_from_codes(codes_at) == produce_org_info(version)
@@ -0,0 +1,174 @@
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+from tests import Clock
+from server.resilience import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryPolicy,
+    parse_retry_after,
+    send_with_retries,
+)
+
+
+def response(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
+
+
+class Upstream:
+    """Returns (or raises) the given outcomes in order."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def send(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def connect_failure():
+    """Like requests raises when the connection could not be opened."""
+    reason = NewConnectionError(None, "Failed to establish a new connection: [Errno 111] Connection refused")
+    return requests.ConnectionError(MaxRetryError(None, "/rest/api/2/issue", reason))
+
+
+def retry_policy(sleeps, **kwargs):
+    return RetryPolicy(sleep=sleeps.append, jitter=lambda low, high: high, **kwargs)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT", clock=lambda: 1445412470) == 10
+    assert parse_retry_after("soon") is None
+
+
+def test_retry_policy_backoff_is_capped():
+    policy = RetryPolicy(attempts=10, base_delay=1, max_delay=5, jitter=lambda low, high: high)
+
+    assert [policy.delay(retry) for retry in range(10)] == [1, 2, 4, 5, 5, 5, 5, 5, 5, None]
+    assert policy.delay(0, retry_after=30) == 30
+    assert policy.delay(0, retry_after=3600) is None
+
+
+def test_retries_transient_failures_with_backoff():
+    sleeps = []
+    upstream = Upstream(connect_failure(), response(503), response(201))
+
+    assert send_with_retries(upstream.send, retry_policy(sleeps)).status_code == 201
+    assert sleeps == [0.5, 1.0]
+
+
+def test_honors_retry_after():
+    sleeps = []
+    upstream = Upstream(response(429, {"Retry-After": "7"}), response(201))
+
+    assert send_with_retries(upstream.send, retry_policy(sleeps)).status_code == 201
+    assert sleeps == [7]
+
+
+def test_gives_up_after_attempts():
+    sleeps = []
+    upstream = Upstream(*[response(503)] * 3)
+
+    assert send_with_retries(upstream.send, retry_policy(sleeps, attempts=3)).status_code == 503
+    assert upstream.calls == 3
+
+
+def test_does_not_retry_errors_after_request_was_sent():
+    upstream = Upstream(requests.ReadTimeout("timed out"), response(400))
+
+    with pytest.raises(requests.ReadTimeout):
+        send_with_retries(upstream.send, retry_policy([]))
+    assert send_with_retries(upstream.send, retry_policy([])).status_code == 400
+    assert upstream.calls == 2
+
+
+def test_retries_connect_timeouts():
+    sleeps = []
+    upstream = Upstream(requests.ConnectTimeout("timed out"), response(201))
+
+    assert send_with_retries(upstream.send, retry_policy(sleeps)).status_code == 201
+    assert sleeps == [0.5]
+
+
+def test_does_not_retry_aborted_connections():
+    aborted = requests.ConnectionError(
+        ProtocolError("Connection aborted.", ConnectionResetError(104, "Connection reset by peer"))
+    )
+    upstream = Upstream(aborted, response(201))
+    breaker = CircuitBreaker(failure_threshold=1)
+
+    with pytest.raises(requests.ConnectionError):
+        send_with_retries(upstream.send, retry_policy([]), breaker)
+    assert upstream.calls == 1
+    assert breaker.state == OPEN
+
+
+def test_circuit_breaker_opens_and_recovers():
+    clock = Clock()
+    states = []
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock, on_state_change=states.append)
+    policy = retry_policy([], attempts=1)
+    upstream = Upstream(response(500), requests.ReadTimeout("timed out"), response(503), response(201))
+
+    send_with_retries(upstream.send, policy, breaker)
+    assert breaker.state == CLOSED
+    with pytest.raises(requests.ReadTimeout):
+        send_with_retries(upstream.send, policy, breaker)
+    assert breaker.state == OPEN
+
+    clock.now = 10
+    with pytest.raises(CircuitOpenError) as error:
+        send_with_retries(upstream.send, policy, breaker)
+    assert error.value.retry_after == 20
+    assert upstream.calls == 2
+
+    # A failed trial call opens the breaker again
+    clock.now = 30
+    assert breaker.state == HALF_OPEN
+    send_with_retries(upstream.send, policy, breaker)
+    assert breaker.state == OPEN
+
+    clock.now = 60
+    assert send_with_retries(upstream.send, policy, breaker).status_code == 201
+    assert breaker.state == CLOSED
+    assert [state for state in states if state != CLOSED] == [OPEN, HALF_OPEN, OPEN, HALF_OPEN]
+
+
+def test_half_open_breaker_lets_one_trial_call_through():
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+
+    clock.now = 30
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    breaker.before_call()
+
+
+def test_other_errors_end_the_trial_call():
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+    upstream = Upstream(TypeError("not serializable"), response(201))
+
+    clock.now = 30
+    with pytest.raises(TypeError):
+        send_with_retries(upstream.send, retry_policy([]), breaker)
+    assert breaker.state == HALF_OPEN
+    assert send_with_retries(upstream.send, retry_policy([]), breaker).status_code == 201
+    assert breaker.state == CLOSED
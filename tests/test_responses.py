@@ -0,0 +1,37 @@
+import pytest
+
+from server.responses import accepts_gzip, etag_matches
+
+
+@pytest.mark.parametrize(
+    "if_none_match,expected",
+    [
+        (None, False),
+        ('"abc"', True),
+        ('W/"abc"', True),
+        ('"other", "abc"', True),
+        ("*", True),
+        ('"other"', False),
+    ],
+)
+def test_etag_matches(if_none_match, expected):
+    assert etag_matches(if_none_match, '"abc"') is expected
+
+
+def test_etag_matches_any_etag():
+    assert etag_matches('"abc-gz"', '"abc"', '"abc-gz"')
+    assert not etag_matches('"abc"', '"abc-gz"')
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,expected",
+    [
+        (None, False),
+        ("gzip, deflate, br", True),
+        ("br;q=1.0, gzip;q=0.8", True),
+        ("gzip;q=0", False),
+        ("identity", False),
+    ],
+)
+def test_accepts_gzip(accept_encoding, expected):
+    assert accepts_gzip(accept_encoding) is expected
@@ -0,0 +1,144 @@
+import gzip
+import json
+
+import pytest
+
+from tests import resolve_filename
+from server.user_provider import UserDirectoryProvider
+from server.user_directory import (
+    User,
+    decode_cursor,
+    encode_cursor,
+    load_user_directory,
+    parse_fields,
+    user_from_row,
+)
+
+
+@pytest.fixture()
+def directory():
+    return load_user_directory(resolve_filename("test-users-export.csv"))
+
+
+def test_load_user_directory(directory):
+    assert len(directory) == 4
+    assert directory.users[0] == User(
+        name="Åberg, Albert", email="albert.aaberg@ssb.no", email_short="abc@ssb.no"
+    )
+
+
+@pytest.mark.parametrize(
+    "row",
+    [
+        {"userPrincipalName": "abc@ssb.no", "displayName": "  ", "mail": "x@ssb.no"},
+        {"userPrincipalName": "abcd@ssb.no", "displayName": "A  B", "mail": "x@ssb.no"},
+        {"userPrincipalName": "a@ss", "displayName": "A  B", "mail": "x@ssb.no"},
+    ],
+)
+def test_user_from_row_skips_non_applicable_users(row):
+    assert user_from_row(row) is None
+
+
+def test_user_from_row_keeps_consultants():
+    user = user_from_row(
+        {"userPrincipalName": "konsxyz@ssb.no", "displayName": "Kon  Sulent", "mail": "KS@ssb.no"}
+    )
+    assert user == User(name="Kon, Sulent", email="ks@ssb.no", email_short="konsxyz@ssb.no")
+
+
+@pytest.mark.parametrize(
+    "fields,expected",
+    [
+        (None, ("name", "email", "email_short")),
+        ("", ("name", "email", "email_short")),
+        ("unknown", ("name", "email", "email_short")),
+        ("email_short, name", ("name", "email_short")),
+        ("email", ("email",)),
+    ],
+)
+def test_parse_fields(fields, expected):
+    assert parse_fields(fields) == expected
+
+
+def test_as_dicts(directory):
+    assert directory.as_dicts(("email_short",))[:2] == [
+        {"email_short": "abc@ssb.no"},
+        {"email_short": "don@ssb.no"},
+    ]
+
+
+def test_version_is_derived_from_content(directory):
+    again = load_user_directory(resolve_filename("test-users-export.csv"))
+    assert directory.version and directory.version == again.version
+
+
+def test_provider_reloads_changed_file(tmp_path):
+    export = tmp_path / "users.csv"
+    export.write_text("userPrincipalName,displayName,mail\nabc@ssb.no,Åberg  Albert,a@ssb.no\n", encoding="utf-8")
+    provider = UserDirectoryProvider(str(export))
+    first = provider.load()
+
+    assert provider.reload_if_changed() is False
+    assert provider.get() is first
+
+    with open(export, "a", encoding="utf-8") as file:
+        file.write("don@ssb.no,Duck  Donald,d@ssb.no\n")
+
+    assert provider.reload_if_changed() is True
+    assert len(provider.get()) == 2
+    assert provider.get().version != first.version
+
+
+def test_provider_keeps_last_snapshot_on_failure(tmp_path):
+    export = tmp_path / "users.csv"
+    export.write_text("userPrincipalName,displayName,mail\nabc@ssb.no,Åberg  Albert,a@ssb.no\n", encoding="utf-8")
+    provider = UserDirectoryProvider(str(export))
+    first = provider.load()
+
+    export.unlink()
+
+    assert provider.reload_if_changed() is False
+    assert provider.get() is first
+
+
+def test_encoded_projections(directory):
+    directory.warm()
+    encoded = directory.encoded(("name", "email_short"))
+
+    assert len(directory._encoded) == 7
+    assert directory.encoded(("name", "email_short")) is encoded
+    assert json.loads(encoded.body) == directory.as_dicts(("name", "email_short"))
+    assert gzip.decompress(encoded.gzip_body) == encoded.body
+    assert encoded.etag == f'"{directory.version}-name+email_short"'
+    assert encoded.gzip_etag == f'"{directory.version}-name+email_short-gz"'
+
+
+def test_lookup(directory):
+    found, unknown = directory.lookup([" don@ssb.no", "nobody@ssb.no"])
+
+    assert [user.email_short for user in found] == ["don@ssb.no"]
+    assert unknown == ["nobody@ssb.no"]
+
+
+def test_page(directory):
+    users, after = directory.page(limit=2)
+    assert [user.email_short for user in users] == ["abc@ssb.no", "don@ssb.no"]
+    assert after == "don@ssb.no"
+
+    users, after = directory.page(after, limit=2)
+    assert [user.email_short for user in users] == ["lab@ssb.no", "mim@ssb.no"]
+    assert after is None
+
+
+def test_cursor_roundtrip():
+    assert decode_cursor(encode_cursor("abc@ssb.no")) == "abc@ssb.no"
+    with pytest.raises(ValueError):
+        decode_cursor("%%%")
+
+
+def test_user_is_compact_and_immutable(directory):
+    user = directory.users[0]
+
+    assert not hasattr(user, "__dict__")
+    with pytest.raises(AttributeError):
+        user.name = "Other"
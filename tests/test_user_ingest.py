@@ -0,0 +1,84 @@
+import io
+
+import pytest
+
+from tests import resolve_filename
+from server import user_ingest
+from server.user_directory import parse_user_export
+from server.user_ingest import filter_columns, ingest_user_export, read_chunks
+
+export = resolve_filename("test-users-export.csv")
+
+
+def test_filter_columns():
+    assert filter_columns(
+        [" abc@ssb.no", "abcd@ssb.no", "konsxy@ssb.no", "a@s", "def@ssb.no"],
+        ["Åberg  Albert ", "Long  Principal", "Kon  Sulent", "Short  Principal", "  "],
+        ["Albert.Aaberg@ssb.no", "lp@ssb.no", "KS@ssb.no", "sp@ssb.no", "no@ssb.no"],
+    ) == [
+        ("Åberg, Albert", "albert.aaberg@ssb.no", "abc@ssb.no"),
+        ("Kon, Sulent", "ks@ssb.no", "konsxy@ssb.no"),
+    ]
+
+
+def test_read_chunks_end_at_line_boundaries():
+    file = io.BytesIO(b"aaaa\nbbbbbbbb\ncc\nd")
+
+    assert list(read_chunks(file, 3)) == [b"aaaa\n", b"bbbbbbbb\n", b"cc\nd"]
+
+
+def test_read_chunks_do_not_split_quoted_fields():
+    file = io.BytesIO(b'a,"b\n""c""\nd"\ne,f\n')
+
+    assert list(read_chunks(file, 3)) == [b'a,"b\n""c""\nd"\n', b"e,f\n"]
+
+
+def _same_as_row_loop(path, **kwargs):
+    with open(path, mode="rb") as file:
+        expected = parse_user_export(file.read())
+    directory = ingest_user_export(path, **kwargs)
+
+    assert list(directory) == list(expected)
+    assert directory.version == expected.version
+
+
+def test_ingest_matches_row_loop():
+    _same_as_row_loop(export)
+    _same_as_row_loop(export, chunk_size=16)
+
+
+def test_ingest_in_parallel(tmp_path):
+    path = tmp_path / "users.csv"
+    lines = ["﻿mail,userPrincipalName,displayName"]
+    lines += [f"user{i}@ssb.no,{i:03d}@ssb.no,Name{i}  Given" for i in range(500)]
+    lines += ["missing@ssb.no"]
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    _same_as_row_loop(str(path), chunk_size=1024, workers=2)
+
+
+def test_ingest_quoted_line_breaks(tmp_path):
+    path = tmp_path / "users.csv"
+    lines = ["userPrincipalName,displayName,mail"]
+    lines += [f"u{i:03d}@ssb.no,Name{i}  Given,u{i}@ssb.no" for i in range(200)]
+    for position in range(1, len(lines), 7):
+        lines.insert(position, f'm{position:02d}@ssb.no,"Multi\nLine  Name",m{position}@ssb.no')
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    # Small chunks, so quoted line breaks span chunk boundaries at many offsets
+    for chunk_size in (100, 333, 1000):
+        _same_as_row_loop(str(path), chunk_size=chunk_size)
+
+
+def test_ingest_rejects_export_modified_while_read(tmp_path, monkeypatch):
+    path = tmp_path / "users.csv"
+    path.write_bytes(b"userPrincipalName,displayName,mail\nabc@ssb.no,Name  Given,abc@ssb.no\n")
+
+    def read_and_modify(file, chunk_size):
+        yield from read_chunks(file, chunk_size)
+        with open(path, mode="ab") as other:
+            other.write(b"def@ssb.no,Other  Name,def@ssb.no\n")
+
+    monkeypatch.setattr(user_ingest, "read_chunks", read_and_modify)
+    with pytest.raises(ValueError):
+        ingest_user_export(str(path))
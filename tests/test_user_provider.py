@@ -0,0 +1,91 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from server.user_provider import FileUserSource, HttpUserSource, UserDirectoryProvider, user_source
+
+export_v1 = "userPrincipalName,displayName,mail\nabc@ssb.no,Åberg  Albert,a@ssb.no\n".encode("utf-8")
+export_v2 = export_v1 + b"don@ssb.no,Duck  Donald,d@ssb.no\n"
+
+
+class ExportServer:
+    """Local stand-in for a remote users export, supporting ETag and Last-Modified."""
+
+    def __init__(self):
+        self.content = export_v1
+        self.etag = '"v1"'
+        self.available = True
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(dict(self.headers))
+                if not server.available:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                if self.headers.get("If-None-Match") == server.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", server.etag)
+                self.send_header("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+                self.send_header("Content-Length", str(len(server.content)))
+                self.end_headers()
+                self.wfile.write(server.content)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}/users.csv"
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def publish(self, content: bytes, etag: str):
+        self.content = content
+        self.etag = etag
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture()
+def export_server():
+    server = ExportServer()
+    yield server
+    server.close()
+
+
+def test_user_source():
+    assert isinstance(user_source("https://example.com/users.csv"), HttpUserSource)
+    assert isinstance(user_source("tests/test-users-export.csv"), FileUserSource)
+
+
+def test_remote_source_conditional_polling(export_server):
+    provider = UserDirectoryProvider(export_server.url)
+    first = provider.load()
+    assert len(first) == 1
+
+    assert provider.reload_if_changed() is False
+    assert export_server.requests[-1]["If-None-Match"] == '"v1"'
+    assert export_server.requests[-1]["If-Modified-Since"] == "Mon, 01 Jan 2024 00:00:00 GMT"
+    assert provider.get() is first
+
+    export_server.publish(export_v2, '"v2"')
+    assert provider.reload_if_changed() is True
+    assert len(provider.get()) == 2
+
+
+def test_remote_source_unavailable_keeps_last_snapshot(export_server):
+    provider = UserDirectoryProvider(export_server.url)
+    first = provider.load()
+
+    export_server.available = False
+    export_server.publish(export_v2, '"v2"')
+
+    assert provider.reload_if_changed() is False
+    assert provider.get() is first
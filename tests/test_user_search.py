@@ -0,0 +1,74 @@
+import pytest
+
+from server.user_directory import User
+from server.user_search import PrefixIndex, TrigramIndex, search_terms, trigrams
+
+users = [
+    User(name="Åberg, Albert", email="albert.aaberg@ssb.no", email_short="abc@ssb.no"),
+    User(name="Duck, Donald", email="donald.duck@ssb.no", email_short="don@ssb.no"),
+    User(name="Duck, Dolly", email="dolly.duck@ssb.no", email_short="dod@ssb.no"),
+    User(name="Mus, Mikke", email="mikke.mus@ssb.no", email_short="mim@ssb.no"),
+]
+
+
+def test_search_terms():
+    assert search_terms(" Duck,  Donald ") == ["duck", "donald"]
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        ("duck", ["dod@ssb.no", "don@ssb.no"]),
+        ("Don", ["don@ssb.no"]),
+        ("duck do", ["dod@ssb.no", "don@ssb.no"]),
+        ("donald duck", ["don@ssb.no"]),
+        ("åb", ["abc@ssb.no"]),
+        ("aaberg", ["abc@ssb.no"]),
+        ("mim@", ["mim@ssb.no"]),
+        ("mikke.mus@ssb", ["mim@ssb.no"]),
+        ("x", []),
+        ("", []),
+    ],
+)
+def test_prefix_search(query, expected):
+    found = PrefixIndex(users).search(query)
+    assert sorted(user.email_short for user in found) == expected
+
+
+def test_prefix_search_limit():
+    assert len(PrefixIndex(users).search("d", limit=1)) == 1
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        ("aberg", "abc@ssb.no"),
+        ("aaberg", "abc@ssb.no"),
+        ("ÅBERG", "abc@ssb.no"),
+        ("albrt", "abc@ssb.no"),
+        ("donlad duck", "don@ssb.no"),
+        ("dolly", "dod@ssb.no"),
+        ("mikke.mus", "mim@ssb.no"),
+    ],
+)
+def test_fuzzy_search_best_match(query, expected):
+    found = TrigramIndex(users).search(query)
+    assert found[0].email_short == expected
+
+
+def test_fuzzy_search_no_match():
+    assert TrigramIndex(users).search("xyz") == []
+    assert TrigramIndex(users).search("") == []
+
+
+def test_fuzzy_search_bounded_candidates():
+    many = [
+        User(name=f"Hansen, Hans {i}", email=f"hans{i}@ssb.no", email_short=f"h{i:02d}@ssb.no")
+        for i in range(1000)
+    ]
+    index = TrigramIndex(many, max_candidates=5)
+    assert len(index.search("hansen", limit=10)) == 5
+
+
+def test_trigrams():
+    assert trigrams("ab") == {"  a", " ab", "ab "}
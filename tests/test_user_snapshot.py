@@ -0,0 +1,56 @@
+import pytest
+
+from tests import resolve_filename
+from server.user_directory import load_user_directory
+from server.user_snapshot import is_user_snapshot, main, map_user_snapshot
+
+export = resolve_filename("test-users-export.csv")
+
+
+@pytest.fixture()
+def snapshot(tmp_path):
+    path = str(tmp_path / "users.snapshot")
+    main([export, path])
+    return path
+
+
+def test_snapshot_contains_filtered_users(snapshot):
+    expected = load_user_directory(export)
+    mapped = map_user_snapshot(snapshot)
+
+    assert mapped.mapped
+    assert mapped.version == expected.version
+    assert list(mapped) == list(expected)
+    assert mapped.users[-1] == expected.users[-1]
+    assert mapped.users[1:3] == expected.users[1:3]
+
+
+def test_load_user_directory_detects_snapshot(snapshot):
+    assert is_user_snapshot(snapshot)
+    assert not is_user_snapshot(export)
+
+    directory = load_user_directory(snapshot)
+    assert directory.mapped
+    assert directory.search("duck")[0].email_short == "don@ssb.no"
+    assert directory.encoded(("email_short",)).body == load_user_directory(export).encoded(("email_short",)).body
+
+
+def test_mapped_page_and_lookup(snapshot):
+    expected = load_user_directory(export)
+    mapped = map_user_snapshot(snapshot)
+
+    assert mapped.page() == expected.page()
+    after = expected.page(limit=1)[1]
+    assert mapped.page(after=after, limit=2) == expected.page(after=after, limit=2)
+    principals = ["DON@ssb.no", "unknown@ssb.no"] + [user.email_short for user in expected]
+    assert mapped.lookup(principals) == expected.lookup(principals)
+    assert all(isinstance(position, int) for position in mapped.by_principal.values())
+
+
+def test_empty_snapshot(tmp_path):
+    path = str(tmp_path / "empty.snapshot")
+    export_path = tmp_path / "empty.csv"
+    export_path.write_bytes(b"userPrincipalName,displayName,mail\n")
+    main([str(export_path), path])
+
+    assert len(map_user_snapshot(path)) == 0
@@ -0,0 +1,140 @@
+import pytest
+
+from tests import resolve_filename
+from server.user_directory import User, UserDirectory, load_user_directory
+from server import user_store
+from server.user_store import SqliteUserStore, SqliteUserStoreProvider
+
+export = resolve_filename("test-users-export.csv")
+
+
+@pytest.fixture()
+def store(tmp_path):
+    store = SqliteUserStore(str(tmp_path / "users.db"))
+    store.import_export(export)
+    return store
+
+
+def test_import_export(store):
+    directory = load_user_directory(export)
+
+    assert store.version == directory.version
+    assert len(store) == 4
+    assert list(store) == list(directory)
+    assert store.encoded(("email_short",)).body == directory.encoded(("email_short",)).body
+
+
+def test_incremental_import(store):
+    users = list(load_user_directory(export))
+    users[0] = User(name="Åberg, Albertine", email=users[0].email, email_short=users[0].email_short)
+    users.pop()
+    users.append(User(name="Duck, Dolly", email="dolly.duck@ssb.no", email_short="dod@ssb.no"))
+
+    changes = store.import_directory(UserDirectory(users, version="v2"))
+
+    assert changes == {"inserted": 1, "updated": 1, "deleted": 1}
+    assert store.import_directory(UserDirectory(users, version="v2")) == {
+        "inserted": 0,
+        "updated": 0,
+        "deleted": 0,
+    }
+    assert store.lookup(["abc@ssb.no"])[0][0].name == "Åberg, Albertine"
+    assert store.lookup(["mim@ssb.no"]) == ([], ["mim@ssb.no"])
+
+
+def test_store_persists(store):
+    reopened = SqliteUserStore(store.path)
+
+    assert reopened.version == store.version
+    assert len(reopened) == 4
+
+
+def test_page(store):
+    users, after = store.page(limit=3)
+    assert [user.email_short for user in users] == ["abc@ssb.no", "don@ssb.no", "lab@ssb.no"]
+    assert after == "lab@ssb.no"
+
+    users, after = store.page(after, limit=3)
+    assert [user.email_short for user in users] == ["mim@ssb.no"]
+    assert after is None
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        ("duck", ["don@ssb.no"]),
+        ("duck do", ["don@ssb.no"]),
+        ("åb", ["abc@ssb.no"]),
+        ("mikke.mus@ssb", ["mim@ssb.no"]),
+        ('"', []),
+        ("x", []),
+    ],
+)
+def test_search(store, query, expected):
+    assert [user.email_short for user in store.search(query)] == expected
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        ("aberg", "abc@ssb.no"),
+        ("aaberg", "abc@ssb.no"),
+        ("dnald duk", "don@ssb.no"),
+        ("langbien", "lab@ssb.no"),
+    ],
+)
+def test_fuzzy_search(store, query, expected):
+    assert store.fuzzy_search(query)[0].email_short == expected
+
+
+def test_provider_serves_previous_import_without_export(store, tmp_path):
+    provider = SqliteUserStoreProvider(str(tmp_path / "missing.csv"), store)
+
+    assert provider.load() is store
+    assert len(provider.get()) == 4
+
+
+def test_iterating_does_not_hold_connections(tmp_path, monkeypatch):
+    monkeypatch.setattr(user_store, "_iterate_batch_size", 1)
+    store = SqliteUserStore(str(tmp_path / "users.db"), pool_size=2, pool_timeout=1)
+    store.import_export(export)
+    readers = [iter(store), iter(store)]
+    for reader in readers:
+        next(reader)
+
+    assert len(store) == 4
+    assert list(store) == list(load_user_directory(export).page()[0])
+    assert len(list(readers[0])) == 3
+
+
+def test_connection_pool_timeout(tmp_path):
+    store = SqliteUserStore(str(tmp_path / "users.db"), pool_size=1, pool_timeout=0.1)
+
+    with store.connection():
+        with pytest.raises(TimeoutError):
+            len(store)
+    assert len(store) == 0
+
+
+def test_backends_serve_the_same_users(tmp_path):
+    path = tmp_path / "users.csv"
+    path.write_text(
+        "userPrincipalName,displayName,mail\n"
+        "zed@ssb.no,Duck  Zed,zed.duck@ssb.no\n"
+        "don@ssb.no,Duck  Donald,donald.duck@ssb.no\n"
+        "DON@ssb.no,Duck  Donald Fauntleroy,donald.fauntleroy.duck@ssb.no\n"
+        "dai@ssb.no,Duck  Daisy,daisy.duck@ssb.no\n",
+        encoding="utf-8",
+    )
+    directory = load_user_directory(str(path))
+    store = SqliteUserStore(str(tmp_path / "users.db"))
+    store.import_export(str(path))
+
+    assert len(directory) == len(store) == 3
+    assert list(directory) == list(store)
+    assert [user.email_short for user in directory] == ["dai@ssb.no", "DON@ssb.no", "zed@ssb.no"]
+    users, after = directory.page(limit=2)
+    assert (list(users), after) == store.page(limit=2)
+    for query in ("duck", "d", "donald duck", "ssb"):
+        assert directory.search(query, limit=2) == store.search(query, limit=2)
+    assert directory.lookup(["don@ssb.no"]) == store.lookup(["don@ssb.no"])